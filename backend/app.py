@@ -1,38 +1,67 @@
-from flask import Flask, request, jsonify, send_file, after_this_request
+from flask import Flask, request, jsonify, send_file, after_this_request, Response, stream_with_context, g
 from flask_cors import CORS
 import logging
 import os
-import tempfile
 import io
+import atexit
+import contextvars
+import functools
 import subprocess
+import tempfile
+import hashlib
 import json
+import re
 import asyncio      
 import edge_tts      
 from dotenv import load_dotenv
 import numpy as np
 import platform
+import time
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # --- SMART FFMPEG LOADING ---
 try:
     import static_ffmpeg
     static_ffmpeg.add_paths()
-    print("ℹ️  Loaded static-ffmpeg package.")
+    FFMPEG_SOURCE = "static-ffmpeg package"
 except ImportError:
-    print("ℹ️  Using system FFmpeg (static-ffmpeg not installed).")
+    FFMPEG_SOURCE = "system FFmpeg (static-ffmpeg not installed)"
 # ----------------------------
 from google import genai
 from google.genai import types
 from pathlib import Path
+from piper_pool import PiperPool, PiperError, POOL_SUPPORTED, synthesize_once
+from tts_cache import TTSCache, make_key as tts_cache_key
+from sessions import Session, create_session_store
+from batching import MicroBatcher, split_by_padding
+from model_loader import LazyModel, ModelNotReadyError
+from inference_backends import FORK_SAFE_BACKENDS, load_stt, load_emotion
+from vad import NoSpeechError, trim_silence
+from response_cache import ResponseCache, make_key as response_cache_key
+from rate_limiter import PRIORITY_TEXT, PRIORITY_VOICE, QueueTimeout, RetryScheduler, classify_error
+from audio_codecs import OUTPUT_FORMATS, StreamingDecoder, negotiate_format, transcode, transcoding_producer
+from uploads import ChunkedUpload, SpoolUploadStore, UploadError, UploadStore
+import metrics
+from metrics import span
 
 # --- BIBLIOTEKI DO AUDIO ---
-import whisper
-from transformers import pipeline
+import torch
 
-logging.basicConfig(level=logging.INFO)
+# Logi z poziomem i id żądania (X-Request-ID); LOG_LEVEL=DEBUG pokazuje czasy etapów i treść wiadomości
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(metrics.RequestIdFilter())
 logger = logging.getLogger(__name__)
+logger.info(f"ℹ️  Using {FFMPEG_SOURCE}.")
 
 load_dotenv()
 app = Flask(__name__)
-CORS(app, supports_credentials=True)
+CORS(app, supports_credentials=True, expose_headers=["ETag", "X-TTS-Cache", "X-Request-ID", "Upload-Offset"])
 
 # --- KONFIGURACJA GEMINI ---
 API_KEY = os.getenv("GEMINI_API_KEY")
@@ -43,6 +72,14 @@ class ApiLimitExceededError(Exception):
     """Raised when upstream LLM provider reports quota/rate exhaustion."""
 
 
+class LlmQueueTimeoutError(Exception):
+    """Raised when a request waited too long in the local Gemini rate limit queue; retryable."""
+
+
+LLM_QUEUE_TIMEOUT_ERROR = {"error": "AI model is busy, retry shortly", "code": "LLM_QUEUE_TIMEOUT"}
+LLM_QUEUE_TIMEOUT_HEADERS = {"Retry-After": "5"}
+
+
 # --- KONFIGURACJA PIPER TTS (Nowe) ---
 BASE = Path(__file__).resolve().parent
 
@@ -73,6 +110,37 @@ ENV = os.environ.copy()
 ENV["OMP_NUM_THREADS"] = "2"
 ENV["MKL_NUM_THREADS"] = "2"
 
+# Pula stałych procesów Piper - model ONNX ładowany raz na proces, a nie przy każdym żądaniu.
+# Rozmiar puli: PIPER_POOL_SIZE (domyślnie 1) lub per język, np. PIPER_POOL_SIZE_PL=2.
+# PIPER_POOL_SIZE=0 wyłącza pulę (jeden proces na żądanie, jak na Windowsie).
+PIPER_POOL_SIZE = int(os.getenv("PIPER_POOL_SIZE", "1"))
+PIPER_POOL_SIZES = {
+    lang: int(os.getenv(f"PIPER_POOL_SIZE_{lang.upper()}", PIPER_POOL_SIZE))
+    for lang in VOICE_MODELS
+}
+PIPER_TIMEOUT = float(os.getenv("PIPER_TIMEOUT", "60"))
+PIPER_LENGTH_SCALE = 1.0
+piper_pools = {}
+piper_pools_lock = threading.Lock()
+
+# Cache audio TTS (LRU w RAM ograniczone bajtami + opcjonalnie dysk, gdy ustawiono TTS_CACHE_DIR)
+tts_cache = TTSCache(
+    max_bytes=int(float(os.getenv("TTS_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    disk_dir=os.getenv("TTS_CACHE_DIR") or None,
+    disk_max_bytes=int(float(os.getenv("TTS_CACHE_DISK_MAX_MB", "512")) * 1024 * 1024),
+)
+
+# --- SESJE ROZMÓW (historia trzymana po stronie serwera) ---
+# Klient z session_id wysyła tylko nową wiadomość, serwer dopisuje tury przyrostowo.
+# Najstarsze wiadomości ponad SESSION_MAX_MESSAGES trafiają do krótkiego streszczenia.
+session_store = create_session_store(
+    os.getenv("SESSION_BACKEND", "memory"),
+    path=os.getenv("SESSION_DB_PATH", str(BASE / "sessions.db")),
+    ttl=int(os.getenv("SESSION_TTL_SECONDS", str(6 * 3600))),
+    max_messages=int(os.getenv("SESSION_MAX_MESSAGES", "20")),
+    summary_max_chars=int(os.getenv("SESSION_SUMMARY_MAX_CHARS", "2000")),
+)
+
 # --- SYSTEM PROMPTS (WIELOJĘZYCZNE) ---
 SYSTEM_INSTRUCTIONS = {
     "pl": """
@@ -175,27 +243,172 @@ SYSTEM_INSTRUCTIONS = {
     """
 }
 
+# --- DEKODOWANIE AUDIO W PAMIĘCI ---
+# Whisper i Wav2Vec oczekują mono 16 kHz float32 - dekodujemy upload RAZ,
+# przez potoki stdin/stdout FFmpeg, bez plików tymczasowych na dysku.
+SAMPLE_RATE = 16000
+# Dłuższe nagrania są ucinane już przy dekodowaniu (FFmpeg nie dekoduje reszty)
+MAX_AUDIO_SECONDS = float(os.getenv("MAX_AUDIO_SECONDS", "60"))
+
+@span("decode")
+def decode_audio_bytes(data, sample_rate=SAMPLE_RATE, max_seconds=MAX_AUDIO_SECONDS, timeout=None):
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", "1", "-ar", str(sample_rate),
+        "-t", str(max_seconds),
+        "pipe:1"
+    ]
+    result = subprocess.run(cmd, input=data, capture_output=True, check=True, timeout=timeout)
+    # frombuffer zwraca widok tylko do odczytu - kopiujemy, bo torch.from_numpy chce zapisywalnej tablicy
+    return np.frombuffer(result.stdout, dtype=np.float32).copy()
+
+# --- UPLOAD AUDIO W KAWAŁKACH (wznawialny) ---
+# POST /upload -> upload_id, PATCH /upload/<id> z nagłówkiem Upload-Offset dokłada bajty,
+# które od razu trafiają do FFmpeg; /process_audio z upload_id dostaje prawie gotowe PCM.
+# Po zerwanym połączeniu GET /upload/<id> zwraca offset, od którego klient wznawia.
+# Przy kilku workerach gunicorna kolejne żądania uploadu trafiają do różnych procesów -
+# wtedy kawałki lądują w pliku we wspólnym katalogu, a dekodowanie rusza dopiero na końcu.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_DECODE_TIMEOUT = 30
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "voice-uploads")
+
+def create_upload_store(workers=1):
+    limits = dict(
+        ttl=int(os.getenv("UPLOAD_TTL_SECONDS", "300")),
+        max_bytes=int(float(os.getenv("UPLOAD_MAX_MB", "25")) * 1024 * 1024),
+        max_active=int(os.getenv("UPLOAD_MAX_ACTIVE", "64"))
+    )
+    if workers > 1:
+        return SpoolUploadStore(
+            UPLOAD_SPOOL_DIR, lambda data, timeout: decode_audio_bytes(data, timeout=timeout), **limits
+        )
+    return UploadStore(lambda: StreamingDecoder(SAMPLE_RATE, MAX_AUDIO_SECONDS), **limits)
+
+chunked_uploads = create_upload_store()
+UPLOAD_NOT_FOUND = {"error": "Unknown or expired upload", "code": "UPLOAD_NOT_FOUND"}
+DECODE_TIMEOUT_ERROR = {"error": "Audio decoding timed out", "code": "DECODE_TIMEOUT"}
+
+def decode_request_audio(source):
+    """Decodes an uploaded file (bytes) or finishes a chunked upload; returns float32 mono PCM."""
+    if isinstance(source, bytes):
+        return decode_audio_bytes(source)
+    if isinstance(source, ChunkedUpload):
+        # Większość nagrania jest już zdekodowana - czekamy tylko na ogon strumienia
+        with span("decode"):
+            return source.finish(timeout=UPLOAD_DECODE_TIMEOUT)
+    # Upload z katalogu wspólnego dekoduje całość przez decode_audio_bytes (z własnym pomiarem)
+    return source.finish(timeout=UPLOAD_DECODE_TIMEOUT)
+
+def analyze_audio_source(source, language):
+    """decode_request_audio + analyze_audio; returns (text, emotion, timings).
+
+    A chunked upload is removed once it has been analyzed or has failed. While the models are
+    still loading (ModelNotReadyError) it is kept with its decoded audio, so the client can retry.
+    """
+    keep_upload = False
+    try:
+        audio, decode_ms = timed(decode_request_audio, source)
+        text, top_emotion, timings = analyze_audio(audio, language)
+    except ModelNotReadyError:
+        keep_upload = True
+        raise
+    finally:
+        if not isinstance(source, bytes) and not keep_upload:
+            chunked_uploads.delete(source.id)
+    timings["decode_ms"] = decode_ms
+    return text, top_emotion, timings
+
+def parse_upload_offset(value):
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise UploadError("Invalid Upload-Offset header", 400)
+    return int(value)
+
+def upload_state(upload):
+    return {"upload_id": upload.id, "offset": upload.offset}, {"Upload-Offset": str(upload.offset)}
+
+def upload_error_body(e):
+    body, headers = {"error": str(e)}, {}
+    if e.offset is not None:
+        body["offset"], headers["Upload-Offset"] = e.offset, str(e.offset)
+    return body, headers
+
+# --- BUDŻET WĄTKÓW DLA INFERENCJI ---
+# Whisper i Wav2Vec liczą równolegle w osobnych wątkach, więc dzielimy rdzenie między nie,
+# żeby dwa równoległe przebiegi nie walczyły o ten sam zestaw wątków OpenMP.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+TORCH_THREADS = int(os.getenv("TORCH_NUM_THREADS", max(1, (os.cpu_count() or 2) // INFERENCE_WORKERS)))
+torch.set_num_threads(TORCH_THREADS)
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+# Micro-batching (INFERENCE_BATCHING=1): równoległe żądania są zbierane w paczki
+# do BATCH_MAX_SIZE klipów lub BATCH_MAX_WAIT_MS i liczone jednym przebiegiem modelu.
+INFERENCE_BATCHING = os.getenv("INFERENCE_BATCHING", "0") == "1"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "25"))
+# Wav2Vec2 (superb-er) nie dostaje maski uwagi i uśrednia wszystkie ramki razem z zerami dopełnienia,
+# więc wynik z paczki różni się od pojedynczego klipu. Dlatego emocje mają osobny przełącznik
+# (sprawdź najpierw: python export_models.py check ... --emotion-batch 8), a paczka jest dzielona
+# na klipy o długości różniącej się najwyżej o EMOTION_BATCH_MAX_PAD.
+EMOTION_BATCHING = INFERENCE_BATCHING and os.getenv("EMOTION_BATCHING", "0") == "1"
+EMOTION_BATCH_MAX_PAD = float(os.getenv("EMOTION_BATCH_MAX_PAD", "0.05"))
+
+# --- VAD (wykrywanie mowy) ---
+# Przed STT i emocjami wycinamy ciszę i długie pauzy - modele liczą tylko mowę,
+# a nagranie bez mowy kończy się 422 bez wywołania Gemini.
+VAD_ENABLED = os.getenv("VAD_ENABLED", "1") == "1"
+VAD_THRESHOLD_DB = float(os.getenv("VAD_THRESHOLD_DB", "-50"))
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "250"))
+VAD_PADDING_MS = int(os.getenv("VAD_PADDING_MS", "200"))
+
 # --- INICJALIZACJA MODELI ---
-print("⏳ Ładowanie modelu Whisper (STT)...")
-stt_model = whisper.load_model("base")
+# MODEL_LOADING:
+#   eager      - ładujemy wszystko przed startem serwera (jak dawniej)
+#   background - serwer startuje od razu, modele ładują się równolegle w tle
+#   lazy       - każdy model ładuje się dopiero przy pierwszym użyciu
+#   preload    - tryb wieloprocesowy (gunicorn.conf.py): modele torch ładujemy w procesie master
+#                przed fork(), workery dzielą je copy-on-write; pozostałe ładuje każdy worker w tle
+# /chat nie potrzebuje modeli audio, więc w trybach background/lazy działa od pierwszej sekundy.
+MODEL_LOADING = os.getenv("MODEL_LOADING", "eager")
+# Ile sekund żądanie audio czeka na model, zanim dostanie 503
+MODEL_WAIT_SECONDS = float(os.getenv("MODEL_WAIT_SECONDS", "60"))
+
+# Backend inferencji (inference_backends.py):
+#   STT_BACKEND:     torch | torch-int8 | ctranslate2 (faster-whisper)
+#   EMOTION_BACKEND: torch | torch-int8 | onnx (ONNX Runtime, int8)
+# Eksport modeli i porównanie z fp32: python export_models.py --help
+STT_BACKEND = os.getenv("STT_BACKEND", "torch")
+EMOTION_BACKEND = os.getenv("EMOTION_BACKEND", "torch")
 
-print("⏳ Ładowanie modelu Emocji (Wav2Vec)...")
-emotion_classifier = pipeline("audio-classification", model="superb/wav2vec2-base-superb-er")
+stt_loader = LazyModel("whisper", lambda: load_stt(STT_BACKEND, TORCH_THREADS))
+emotion_loader = LazyModel("emotion", lambda: load_emotion(EMOTION_BACKEND, TORCH_THREADS))
+AUDIO_MODELS = (stt_loader, emotion_loader)
+# ONNX Runtime, CTranslate2 i kwantyzacja int8 mają stan (pule wątków), który nie przeżywa fork() - tych nie ładujemy w masterze
+FORK_SAFE_MODELS = tuple(
+    model for model, backend in ((stt_loader, STT_BACKEND), (emotion_loader, EMOTION_BACKEND))
+    if backend in FORK_SAFE_BACKENDS
+)
 
 # --- START: WARM-UP (ROZGRZEWKA MODELI) ---
 # Wykonujemy tylko na Windowsie (lokalnie), gdzie mamy kontrolę nad czasem.
 # Na Hugging Face (Linux) pomijamy to, żeby zmieścić się w limicie czasu startu (30s).
-if platform.system() == "Windows":
-    print("🔥 Rozgrzewanie modeli (Ghost Run)...")
+def warm_up_models():
+    if platform.system() != "Windows":
+        logger.info("🐧 Wykryto środowisko Linux (Chmura) - Pomijam 'Ghost Run' dla szybszego startu.")
+        return
+    logger.info("🔥 Rozgrzewanie modeli (Ghost Run)...")
     try:
         # Generujemy 1 sekundę ciszy
         dummy_audio = np.zeros(16000, dtype=np.float32)
 
         # 1. Przepuszczamy ducha przez Whisper
-        stt_model.transcribe(dummy_audio, language="pl")
+        stt_loader.get().transcribe(dummy_audio, "pl")
         
         # 2. Przepuszczamy ducha przez Wav2Vec
-        emotion_classifier(dummy_audio)
+        emotion_loader.get()(dummy_audio)
 
         # 3. Przepuszczamy ducha przez Pipera (Cache dyskowy + test binarki)
         default_model = VOICE_MODELS["pl"]["model"]
@@ -210,13 +423,147 @@ if platform.system() == "Windows":
                 env=ENV
             )
 
-        print("🚀 Wszystkie systemy (Whisper, Emotion, Piper) gotowe do akcji!")
+        logger.info("🚀 Wszystkie systemy (Whisper, Emotion, Piper) gotowe do akcji!")
     except Exception as e:
-        print(f"⚠️ Ostrzeżenie: Nie udało się w pełni rozgrzać modeli (błąd: {e})")
-else:
-    print("🐧 Wykryto środowisko Linux (Chmura) - Pomijam 'Ghost Run' dla szybszego startu.")
+        logger.warning(f"⚠️ Nie udało się w pełni rozgrzać modeli (błąd: {e})")
 # --- KONIEC WARM-UP ---
-print("✅ Backend gotowy!")
+
+def load_models_in_background():
+    # Oba modele ładują się równolegle; rozgrzewka dopiero gdy oba są gotowe
+    for model in AUDIO_MODELS:
+        model.start()
+    try:
+        for model in AUDIO_MODELS:
+            model.get()
+    except ModelNotReadyError:
+        return
+    warm_up_models()
+
+if MODEL_LOADING == "eager":
+    for model in AUDIO_MODELS:
+        model.load()
+    warm_up_models()
+elif MODEL_LOADING == "background":
+    threading.Thread(target=load_models_in_background, daemon=True, name="model-loading").start()
+elif MODEL_LOADING == "preload":
+    # Bez rozgrzewki - master nie może uruchomić inferencji (pula OpenMP) przed fork()
+    for model in FORK_SAFE_MODELS:
+        model.load()
+elif MODEL_LOADING != "lazy":
+    raise ValueError(f"Unknown MODEL_LOADING mode: {MODEL_LOADING}")
+logger.info("✅ Backend gotowy!")
+
+def audio_models_ready():
+    return all(model.state == "ready" for model in AUDIO_MODELS)
+
+NO_SPEECH_ERROR = {"error": "No speech detected", "code": "NO_SPEECH_DETECTED"}
+
+def models_loading_error(e):
+    """JSON body and headers of the 503 returned while audio models are still loading."""
+    return {
+        "error": "Audio models are still loading",
+        "code": "MODELS_LOADING",
+        "model": e.name,
+        "state": e.state
+    }, {"Retry-After": "10"}
+
+# Funkcje pomocnicze dla etapów inferencji audio (uruchamiane w inference_executor)
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+def submit_inference(fn, *args):
+    # Kopia kontekstu - id żądania trafia też do logów z wątków inferencji
+    return inference_executor.submit(contextvars.copy_context().run, timed, fn, *args)
+
+@span("stt")
+def run_stt(audio, language):
+    return stt_loader.get().transcribe(audio, "pl" if language == "pl" else "en")
+
+@span("emotion")
+def run_emotion(audio):
+    emotions = emotion_loader.get()(audio)
+    return emotions[0]['label']
+
+@span("stt_batch")
+def run_stt_batch(audios, language):
+    return stt_loader.get().transcribe_batch(audios, "pl" if language == "pl" else "en")
+
+@span("emotion_batch")
+def run_emotion_batch(audios, _key=None):
+    # Pipeline dopełnia klipy w paczce zerami do najdłuższego - batcher układa je wg długości,
+    # a tu paczka dzieli się na przebiegi z ograniczonym dopełnieniem
+    labels = []
+    for run in split_by_padding(audios, EMOTION_BATCH_MAX_PAD):
+        results = emotion_loader.get()(run, batch_size=len(run))
+        labels.extend(emotions[0]['label'] for emotions in results)
+    return labels
+
+stt_batcher = MicroBatcher("whisper", run_stt_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+emotion_batcher = MicroBatcher("emotion", run_emotion_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+def analyze_audio(audio, language):
+    """Trims silence, then runs STT and emotion classification concurrently; returns (text, emotion, timings).
+
+    Raises NoSpeechError for clips without speech and ModelNotReadyError if the models
+    do not finish loading within MODEL_WAIT_SECONDS.
+    """
+    vad_ms = 0.0
+    if VAD_ENABLED:
+        with span("vad"):
+            speech, vad_ms = timed(
+                trim_silence, audio, SAMPLE_RATE,
+                threshold_db=VAD_THRESHOLD_DB, min_speech_ms=VAD_MIN_SPEECH_MS, padding_ms=VAD_PADDING_MS
+            )
+        logger.debug(f"🔇 VAD: {len(audio) / SAMPLE_RATE:.1f}s nagrania -> {len(speech) / SAMPLE_RATE:.1f}s mowy")
+        audio = speech
+    text, top_emotion, timings = infer_audio(audio, language)
+    timings["vad_ms"] = vad_ms
+    return text, top_emotion, timings
+
+def infer_audio(audio, language):
+    for model in AUDIO_MODELS:
+        model.start()
+    for model in AUDIO_MODELS:
+        model.get(timeout=MODEL_WAIT_SECONDS)
+    if INFERENCE_BATCHING:
+        start = time.perf_counter()
+        stt_future = stt_batcher.submit(audio, key=language)
+        if EMOTION_BATCHING:
+            emotion_future = emotion_batcher.submit(audio)
+            top_emotion = emotion_future.result()
+            emotion_ms = round((emotion_future.completed_at - start) * 1000, 1)
+        else:
+            top_emotion, emotion_ms = submit_inference(run_emotion, audio).result()
+        return stt_future.result(), top_emotion, {
+            "stt_ms": round((stt_future.completed_at - start) * 1000, 1),
+            "emotion_ms": emotion_ms,
+        }
+
+    stt_future = submit_inference(run_stt, audio, language)
+    emotion_future = submit_inference(run_emotion, audio)
+    text, stt_ms = stt_future.result()
+    top_emotion, emotion_ms = emotion_future.result()
+    return text, top_emotion, {"stt_ms": stt_ms, "emotion_ms": emotion_ms}
+
+# --- WSPÓLNA PĘTLA ASYNCIO ---
+# Edge TTS jest asynchroniczne; zamiast asyncio.run() (nowa pętla na każde żądanie)
+# korutyny z wątków Flaska trafiają na jedną pętlę działającą w tle.
+_async_loop = None
+_async_loop_pid = None
+_async_loop_lock = threading.Lock()
+
+def run_async(coro):
+    """Runs a coroutine on the shared background event loop and waits for its result."""
+    global _async_loop, _async_loop_pid
+    with _async_loop_lock:
+        # Po forku wątek pętli nie istnieje - każdy proces tworzy własną
+        if _async_loop is None or _async_loop_pid != os.getpid():
+            _async_loop = asyncio.new_event_loop()
+            _async_loop_pid = os.getpid()
+            threading.Thread(target=_async_loop.run_forever, daemon=True, name="asyncio-loop").start()
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop).result()
 
 # Funkcja pomocnicza do generowania Edge TTS
 async def generate_edge_audio_memory(text, voice):
@@ -229,265 +576,1041 @@ async def generate_edge_audio_memory(text, voice):
     audio_stream.seek(0)
     return audio_stream
     
-def generate_gemini_response(user_text, language="pl", emotion=None, history=None):
-    # 1. Wybór instrukcji i dodanie emocji jako "meta-dane" (ukryte)
-    current_instruction = SYSTEM_INSTRUCTIONS.get(language, SYSTEM_INSTRUCTIONS["pl"])
-    if emotion:
-        current_instruction += f"\n(META-DATA: User emotion: {emotion} - adjust tone, do not quote this tag)."
-
-    # 2. Budowanie wyraźnego bloku historii
-    context_string = ""
-    if history and isinstance(history, list) and len(history) > 0:
-        context_string += "\n=== HISTORIA ROZMOWY (To co już ustaliliśmy) ===\n"
-        for msg in history:
-            role = "Użytkownik" if msg.get("role") == "user" else "Ty (Asystent)"
-            text = msg.get("text", "")
-            context_string += f"{role}: {text}\n"
-        context_string += "=== KONIEC HISTORII ===\n"
-        print(f"📜 AI otrzymało historię: {len(history)} wiadomości")
-        print(f"Historia: {history}")
+GEMINI_MODEL = 'gemini-flash-lite-latest'
+
+# --- LIMITY I PONOWIENIA GEMINI ---
+# Token bucket dopasowany do limitu RPM (GEMINI_RPM=0 wyłącza), ponowienia z jitterem przy 429/5xx,
+# tury głosowe przed tekstowymi w kolejce, a po wyczerpaniu limitu dziennego - model zapasowy.
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "")
+
+def create_gemini_scheduler(workers=1):
+    """Scheduler for one process; with several workers the per-key RPM limit is split between them."""
+    return RetryScheduler(
+        [GEMINI_MODEL, GEMINI_FALLBACK_MODEL],
+        rate_per_minute=float(os.getenv("GEMINI_RPM", "15")) / workers,
+        burst=max(1, int(os.getenv("GEMINI_BURST", "5")) // workers),
+        max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+        backoff_base=float(os.getenv("GEMINI_BACKOFF_BASE", "1.0")),
+        backoff_max=float(os.getenv("GEMINI_BACKOFF_MAX", "20")),
+        queue_timeout=float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30")),
+        exhausted_cooldown=float(os.getenv("GEMINI_EXHAUSTED_COOLDOWN", "900"))
+    )
+
+gemini_scheduler = create_gemini_scheduler()
+
+# --- BUDOWANIE PROMPTU (natywne tury Gemini + budżet tokenów + cache instrukcji) ---
+# Historia trafia do Gemini jako osobne tury types.Content, przycięte od najstarszych
+# do PROMPT_TOKEN_BUDGET. Statyczna instrukcja systemowa danego języka jest
+# trzymana w explicit context cache Gemini, więc nie wysyłamy jej przy każdym żądaniu.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Po nieudanym utworzeniu cache (np. instrukcja poniżej minimalnego rozmiaru dla modelu) nie próbujemy co chwilę
+CONTEXT_CACHE_RETRY_SECONDS = 3600
+
+instruction_caches = {}  # język -> (nazwa cache albo None po błędzie, ważne do)
+instruction_caches_lock = threading.Lock()
+
+# --- CACHE ODPOWIEDZI (pierwsze wiadomości rozmowy) ---
+# Pierwsza wiadomość bez historii (powitania, podpowiedzi z UI) zależy tylko od języka, emocji i tekstu -
+# odpowiedź bierzemy z cache, a równoczesne identyczne pytania dzielą jedno wywołanie Gemini.
+GEMINI_RESPONSE_CACHE = os.getenv("GEMINI_RESPONSE_CACHE", "1") == "1"
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("GEMINI_RESPONSE_CACHE_SIZE", "512")),
+    ttl=int(os.getenv("GEMINI_RESPONSE_CACHE_TTL", "3600"))
+)
+
+def first_turn_cache_key(user_text, language, emotion, history, summary):
+    """Cache key for a reply without prior context, or None if the turn is not cacheable."""
+    if not GEMINI_RESPONSE_CACHE or history or summary:
+        return None
+    language = language if language in SYSTEM_INSTRUCTIONS else "pl"
+    return response_cache_key(GEMINI_MODEL, SYSTEM_INSTRUCTIONS[language], language, emotion, user_text)
+
+def estimate_tokens(text):
+    # Przybliżenie bez wołania API: ~4 znaki na token dla tekstu PL/EN
+    return len(text) // 4 + 1
+
+def get_instruction_cache(language):
+    if not GEMINI_CONTEXT_CACHE:
+        return None
+    now = time.time()
+    with instruction_caches_lock:
+        entry = instruction_caches.get(language)
+        # Margines 60 s, żeby cache nie wygasł w trakcie generowania
+        if entry and entry[1] - 60 > now:
+            return entry[0]
+        try:
+            display_name = instruction_cache_display_name(language)
+            shared = find_instruction_cache(display_name, now)
+            if shared is not None:
+                instruction_caches[language] = shared
+                logger.info(f"🗄️ Używam istniejącego cache instrukcji Gemini dla '{language}': {shared[0]}")
+                return shared[0]
+            cache = client.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    display_name=display_name,
+                    system_instruction=SYSTEM_INSTRUCTIONS[language],
+                    ttl=f"{GEMINI_CONTEXT_CACHE_TTL}s",
+                )
+            )
+            instruction_caches[language] = (cache.name, now + GEMINI_CONTEXT_CACHE_TTL)
+            logger.info(f"🗄️ Utworzono cache instrukcji Gemini dla '{language}': {cache.name}")
+            return cache.name
+        except Exception as e:
+            logger.warning(f"Context cache Gemini niedostępny dla '{language}' ({e}) - wysyłam instrukcję w żądaniu")
+            instruction_caches[language] = (None, now + CONTEXT_CACHE_RETRY_SECONDS)
+            return None
+
+def instruction_cache_display_name(language):
+    # Skrót modelu i treści instrukcji w nazwie - po zmianie promptu stary cache nie zostanie użyty
+    digest = hashlib.sha256(f"{GEMINI_MODEL}\x00{SYSTEM_INSTRUCTIONS[language]}".encode("utf-8")).hexdigest()[:12]
+    return f"travel-assistant-{language}-{digest}"
+
+def find_instruction_cache(display_name, now):
+    """Returns (name, expires_at) of a live cache created by another worker (or an earlier run), or None.
+
+    With several gunicorn workers each one would otherwise create (and pay storage for) its own copy.
+    """
+    for cache in client.caches.list():
+        expire_time = getattr(cache, "expire_time", None)
+        if cache.display_name != display_name or expire_time is None:
+            continue
+        expires_at = expire_time.timestamp()
+        if expires_at - 60 > now:
+            return cache.name, expires_at
+    return None
+
+def invalidate_instruction_cache(language):
+    with instruction_caches_lock:
+        instruction_caches.pop(language, None)
+
+def is_cache_error(e):
+    return "cache" in str(e).lower()
+
+def trim_history(history, budget):
+    """Keeps the newest messages that fit into the token budget."""
+    kept = []
+    for msg in reversed(history):
+        cost = estimate_tokens(msg.get("text", ""))
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(msg)
+    kept.reverse()
+    return kept
+
+@span("prompt_build")
+def build_gemini_request(user_text, language="pl", emotion=None, history=None, summary="", use_cache=True):
+    language = language if language in SYSTEM_INSTRUCTIONS else "pl"
+    emotion_tag = f"(META-DATA: User emotion: {emotion} - adjust tone, do not quote this tag)." if emotion else None
+
+    # 1. Historia przycięta do budżetu (nowa wiadomość i streszczenie mają pierwszeństwo)
+    budget = PROMPT_TOKEN_BUDGET - estimate_tokens(user_text) - (estimate_tokens(summary) if summary else 0)
+    turns = trim_history(history, budget) if isinstance(history, list) else []
+    if history and len(turns) < len(history):
+        logger.debug(f"✂️ Historia przycięta do budżetu: {len(turns)}/{len(history)} wiadomości")
+
+    # 2. Tury w formacie Gemini - kolejne wiadomości tej samej roli sklejamy, bo role muszą się przeplatać
+    contents = []
+    if summary:
+        contents.append(types.Content(role="user", parts=[types.Part.from_text(
+            text=f"(Streszczenie wcześniejszej rozmowy:\n{summary})"
+        )]))
+    for msg in turns:
+        role = "user" if msg.get("role") == "user" else "model"
+        text = msg.get("text", "")
+        if not text:
+            continue
+        if contents and contents[-1].role == role:
+            contents[-1].parts.append(types.Part.from_text(text=text))
+        else:
+            contents.append(types.Content(role=role, parts=[types.Part.from_text(text=text)]))
+    if contents and contents[0].role == "model":
+        contents.insert(0, types.Content(role="user", parts=[types.Part.from_text(text="(kontynuacja rozmowy)")]))
+
+    # 3. Nowa wiadomość użytkownika
+    cache_name = get_instruction_cache(language) if use_cache else None
+    user_parts = [types.Part.from_text(text=user_text)]
+    if cache_name and emotion_tag:
+        # Instrukcja systemowa jest w cache i nie może się zmieniać - emocja jedzie jako ukryta część tury
+        user_parts.insert(0, types.Part.from_text(text=emotion_tag))
+    if contents and contents[-1].role == "user":
+        contents[-1].parts.extend(user_parts)
     else:
-        print("⚠️ Brak historii - to pierwsza wiadomość")
-    
-    # 3. Sklejenie wszystkiego
-    final_input = f"{context_string}\nTERAZ Użytkownik pisze: {user_text}"
-    
-    print(f"🤖 Pełny prompt dla AI (pierwsze 500 znaków):\n{final_input[:500]}...")
+        contents.append(types.Content(role="user", parts=user_parts))
+
+    prompt_tokens = sum(estimate_tokens(m.get("text", "")) for m in turns) + PROMPT_TOKEN_BUDGET - budget
+    logger.debug(f"🤖 Prompt: {len(contents)} tur, ~{prompt_tokens} tokenów wejścia")
+
+    if cache_name:
+        config = types.GenerateContentConfig(cached_content=cache_name, temperature=0.7)
+    else:
+        current_instruction = SYSTEM_INSTRUCTIONS[language]
+        if emotion_tag:
+            current_instruction += f"\n{emotion_tag}"
+        config = types.GenerateContentConfig(system_instruction=current_instruction, temperature=0.7)
+    return contents, config, language, cache_name is not None
+
+# POST-PROCESSING: Usuń [SYSTEM INFO] jeśli AI zignorowało zakaz
+def scrub_system_tags(text):
+    # Usuń całe linie zawierające [SYSTEM INFO]
+    text = re.sub(r'\[SYSTEM INFO\].*?\n', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'\[SYSTEM.*?\]', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'META-DATA:.*?\n', '', text, flags=re.IGNORECASE)
+    return text
+
+def clean_response_text(text):
+    return scrub_system_tags(text).strip()
+
+class StreamScrubber:
+    """Incremental version of clean_response_text for streamed replies.
+
+    All scrubbed patterns start with a marker and end within a single line, so
+    complete lines are cleaned as they arrive. In the current partial line,
+    text is held back from the first marker (or a possible marker prefix)
+    until the line is complete, so leaked tags are never emitted.
+    """
+
+    MARKERS = ("[system", "meta-data:")
+
+    def __init__(self):
+        self._buffer = ""
+        self._pending_ws = ""
+        self._started = False
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        out = []
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            out.append(scrub_system_tags(line + "\n"))
+        safe = self._safe_length(self._buffer)
+        out.append(self._buffer[:safe])
+        self._buffer = self._buffer[safe:]
+        return self._emit("".join(out))
+
+    def flush(self):
+        tail = self._emit(scrub_system_tags(self._buffer))
+        self._buffer = ""
+        # Końcowe białe znaki odrzucamy, tak jak .strip() w wersji nie-strumieniowej
+        self._pending_ws = ""
+        return tail
+
+    def _safe_length(self, partial):
+        lowered = partial.lower()
+        found = [lowered.find(m) for m in self.MARKERS if m in lowered]
+        if found:
+            return min(found)
+        for hold in range(min(len(lowered), max(map(len, self.MARKERS))), 0, -1):
+            if any(m.startswith(lowered[-hold:]) for m in self.MARKERS):
+                return len(partial) - hold
+        return len(partial)
+
+    def _emit(self, text):
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        text = self._pending_ws + text
+        stripped = text.rstrip()
+        self._pending_ws = text[len(stripped):]
+        return stripped
 
+def is_limit_error(e):
+    return classify_error(e) in ("quota", "rate")
+
+def raise_gemini_error(e):
+    if isinstance(e, QueueTimeout):
+        # Lokalna kolejka token bucketu, a nie limit Gemini - klient może od razu ponowić
+        logger.warning(f"Gemini request queue timeout: {e}")
+        raise LlmQueueTimeoutError(str(e)) from e
+    if is_limit_error(e):
+        logger.warning(f"Gemini quota/rate limit reached: {e}")
+        raise ApiLimitExceededError("API daily limit exceeded") from e
+
+    logger.error(f"Gemini Error: {e}")
+    raise e
+
+def generate_gemini_response(user_text, language="pl", emotion=None, history=None, summary="", priority=PRIORITY_TEXT):
+    key = first_turn_cache_key(user_text, language, emotion, history, summary)
+    if key is None:
+        return call_gemini(user_text, language, emotion, history, summary, priority)
+    return response_cache.get_or_compute(
+        key, lambda: call_gemini(user_text, language, emotion, history, summary, priority)
+    )
+
+def send_with_prompt(send, model, user_text, language, emotion, history, summary):
+    """Builds the prompt for model and returns send(model, contents, config)."""
+    # Context cache instrukcji istnieje tylko dla GEMINI_MODEL - model zapasowy dostaje pełną instrukcję
+    contents, config, language, cached = build_gemini_request(
+        user_text, language, emotion, history, summary, use_cache=model == GEMINI_MODEL
+    )
     try:
-        response = client.models.generate_content(
-            model='gemini-flash-lite-latest',
-            contents=final_input,
-            config=types.GenerateContentConfig(
-                system_instruction=current_instruction,
-                temperature=0.7,
-            )
+        return send(model, contents, config)
+    except Exception as e:
+        if not (cached and is_cache_error(e)):
+            raise
+        # Cache wygasł lub został usunięty po stronie Gemini - jedno ponowienie z pełną instrukcją
+        invalidate_instruction_cache(language)
+        contents, config, _, _ = build_gemini_request(user_text, language, emotion, history, summary, use_cache=False)
+        return send(model, contents, config)
+
+def call_gemini(user_text, language="pl", emotion=None, history=None, summary="", priority=PRIORITY_TEXT):
+    def send(model, contents, config):
+        with span("gemini"):
+            return client.models.generate_content(model=model, contents=contents, config=config)
+
+    try:
+        response = gemini_scheduler.run(
+            lambda model: send_with_prompt(send, model, user_text, language, emotion, history, summary), priority
         )
-        
-        # POST-PROCESSING: Usuń [SYSTEM INFO] jeśli AI zignorowało zakaz
-        clean_response = response.text
-        # Usuń całe linie zawierające [SYSTEM INFO]
-        import re
-        clean_response = re.sub(r'\[SYSTEM INFO\].*?\n', '', clean_response, flags=re.IGNORECASE)
-        clean_response = re.sub(r'\[SYSTEM.*?\]', '', clean_response, flags=re.IGNORECASE)
-        clean_response = re.sub(r'META-DATA:.*?\n', '', clean_response, flags=re.IGNORECASE)
-        
-        return clean_response.strip()
+        return clean_response_text(response.text)
     except Exception as e:
-        error_text = str(e).lower()
-        is_limit_error = any(
-            token in error_text
-            for token in [
-                "429",
-                "quota",
-                "rate limit",
-                "too many requests",
-                "resource_exhausted",
-                "daily limit",
-            ]
+        raise_gemini_error(e)
+
+def generate_gemini_response_stream(user_text, language="pl", emotion=None, history=None, summary="", priority=PRIORITY_TEXT):
+    """Yields cleaned reply fragments as Gemini streams them (a cached first-turn reply comes in one piece)."""
+    key = first_turn_cache_key(user_text, language, emotion, history, summary)
+    cached_reply = response_cache.get(key) if key else None
+    if cached_reply is not None:
+        yield cached_reply
+        return
+    parts = []
+    for piece in stream_gemini(user_text, language, emotion, history, summary, priority):
+        parts.append(piece)
+        yield piece
+    if key:
+        response_cache.put(key, "".join(parts))
+
+def stream_gemini(user_text, language="pl", emotion=None, history=None, summary="", priority=PRIORITY_TEXT):
+    scrubber = StreamScrubber()
+    start = time.perf_counter()
+
+    def send(model, contents, config):
+        # Błędy limitów przychodzą najpóźniej z pierwszym fragmentem - ponawiamy tylko do tego momentu
+        with span("gemini_first_token"):
+            stream = client.models.generate_content_stream(model=model, contents=contents, config=config)
+            return stream, next(stream, None)
+
+    try:
+        stream, first_chunk = gemini_scheduler.run(
+            lambda model: send_with_prompt(send, model, user_text, language, emotion, history, summary), priority
         )
 
-        if is_limit_error:
-            logger.warning(f"Gemini quota/rate limit reached: {e}")
-            raise ApiLimitExceededError("API daily limit exceeded") from e
+        if first_chunk is not None:
+            for chunk in itertools.chain([first_chunk], stream):
+                piece = scrubber.feed(chunk.text or "")
+                if piece:
+                    yield piece
+        tail = scrubber.flush()
+        if tail:
+            yield tail
+        metrics.observe_stage("gemini_stream", time.perf_counter() - start)
+    except Exception as e:
+        raise_gemini_error(e)
+
+# --- SERVER-SENT EVENTS ---
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
-        logger.error(f"Gemini Error: {e}")
-        raise
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def stream_chat_events(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    parts = []
+    try:
+        for piece in generate_gemini_response_stream(
+            user_text, language=language, emotion=emotion, history=session.history, summary=session.summary,
+            priority=priority
+        ):
+            parts.append(piece)
+            yield sse_event("delta", {"text": piece})
+        ai_response = "".join(parts)
+        remember_turn(session, user_text, ai_response)
+        yield sse_event("done", {"response": ai_response, "emotion_detected": emotion, "session_id": session.id})
+    except ApiLimitExceededError:
+        yield sse_event("error", {"error": "API daily limit exceeded", "code": "API_DAILY_LIMIT_EXCEEDED"})
+    except LlmQueueTimeoutError:
+        yield sse_event("error", LLM_QUEUE_TIMEOUT_ERROR)
+    except Exception as e:
+        logger.error(f"Błąd strumienia czatu: {e}")
+        yield sse_event("error", {"error": "AI processing error"})
+
+def parse_history_form():
+    return parse_history_json(request.form.get("history", "[]"))
+
+def parse_history_json(history_json):
+    # Dekodowanie historii z JSON (multipart wysyła ją jako pole tekstowe)
+    try:
+        history = json.loads(history_json)
+        logger.debug(f"📚 Historia zawiera: {len(history)} wiadomości")
+    except:
+        history = []
+        logger.warning("⚠️ Nie udało się zdekodować historii")
+    return history
+
+NEW_SESSION = "new"
+
+def resolve_session(session_id, history):
+    """Returns the Session for this turn; its id is None in the stateless (full history) mode.
+
+    A server-side session is created only on request (session_id="new"), so clients that send
+    the whole history themselves never leave unused sessions behind.
+    """
+    if not isinstance(history, list):
+        history = []
+    if session_id == NEW_SESSION:
+        return session_store.create(history=history)
+    if session_id:
+        session = session_store.get(session_id)
+        if session is None:
+            # Sesja wygasła (albo restart serwera) - odtwarzamy ją z historii przysłanej przez klienta
+            session = session_store.create(session_id, history)
+        return session
+    # Tryb bezstanowy: klient przysyła całą historię (pierwsza tura - pustą), nic nie zapisujemy
+    return Session(id=None, history=history)
+
+def remember_turn(session, user_text, ai_response):
+    if session.id:
+        session_store.append(session.id, [
+            {"role": "user", "text": user_text},
+            {"role": "assistant", "text": ai_response},
+        ])
     
+# Błędne (lub nie-obiektowe) ciało JSON - ta sama odpowiedź 400 we Flasku i w ASGI
+INVALID_JSON_ERROR = {"error": "Invalid JSON body", "code": "INVALID_JSON"}
+
+def read_json_body():
+    data = request.get_json(force=True, silent=True)
+    return data if isinstance(data, dict) else None
+
 # --- ENDPOINT 1: CZAT TEKSTOWY (Szybki) ---
 @app.route("/chat", methods=["POST"])
 def chat():
-    print(f"\n🔍 DEBUG /chat - request.json: {request.json}")
-    
-    data = request.json
+    data = read_json_body()
+    if data is None: return jsonify(INVALID_JSON_ERROR), 400
     user_text = data.get("text")
     language = data.get("language", "pl")
-    history = data.get("history", []) # Pobieramy historię
 
     if not user_text: return jsonify({"error": "Brak tekstu"}), 400
+
+    # Z session_id historia jest na serwerze; bez niego - pełna historia od klienta
+    session = resolve_session(data.get("session_id"), data.get("history", []))
     
-    print(f"\n📨 Otrzymano wiadomość tekstową: '{user_text[:50]}...'")
-    print(f"📚 Historia zawiera: {len(history)} wiadomości")
-    if len(history) > 0:
-        print(f"📋 Szczegóły historii: {history}")
+    logger.debug(f"📨 Wiadomość tekstowa: '{user_text[:50]}...', historia: {len(session.history)} wiadomości")
 
     try:
-        ai_response = generate_gemini_response(user_text, language=language, emotion=None, history=history)
+        ai_response = generate_gemini_response(
+            user_text, language=language, emotion=None, history=session.history, summary=session.summary
+        )
+        remember_turn(session, user_text, ai_response)
         
         return jsonify({
             "response": ai_response,
-            "emotion_detected": None
+            "emotion_detected": None,
+            "session_id": session.id
         })
     except ApiLimitExceededError:
         return jsonify({
             "error": "API daily limit exceeded",
             "code": "API_DAILY_LIMIT_EXCEEDED"
         }), 429
+    except LlmQueueTimeoutError:
+        return jsonify(LLM_QUEUE_TIMEOUT_ERROR), 503, LLM_QUEUE_TIMEOUT_HEADERS
     except Exception as e:
         logger.error(f"Błąd endpointu /chat: {e}")
         return jsonify({"error": "AI processing error"}), 500
 
 # --- ENDPOINT 2: AUDIO (Wolny + Emocje) ---
+def read_audio_source():
+    """Returns the uploaded 'audio' file bytes, or the chunked upload named by 'upload_id' (None if unknown)."""
+    upload_id = request.form.get("upload_id")
+    if upload_id:
+        return chunked_uploads.get(upload_id)
+    with span("upload"):
+        return request.files["audio"].read()
+
 @app.route("/process_audio", methods=["POST"])
 def process_audio():
-    if "audio" not in request.files: return jsonify({"error": "No audio"}), 400
+    if "audio" not in request.files and not request.form.get("upload_id"): return jsonify({"error": "No audio"}), 400
     
     language = request.form.get("language", "pl")
-    
-    # Dekodowanie historii z JSON ---
-    history_json = request.form.get("history", "[]")
-    try:
-        history = json.loads(history_json)
-        print(f"\n🎤 Otrzymano wiadomość audio")
-        print(f"📚 Historia zawiera: {len(history)} wiadomości")
-    except:
-        history = []
-        print("⚠️ Nie udało się zdekodować historii")
-    # -------------------------------------------
-
-    audio_file = request.files["audio"]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as webm_file:
-        audio_file.save(webm_file.name)
-        webm_path = webm_file.name
-    wav_path = webm_path.replace(".webm", ".wav")
+    session = resolve_session(request.form.get("session_id"), parse_history_form())
+
+    audio_source = read_audio_source()
+    if audio_source is None: return jsonify(UPLOAD_NOT_FOUND), 404
+    request_start = time.perf_counter()
     
     try:
-        subprocess.run(
-            ["ffmpeg", "-y", "-i", webm_path, "-ac", "1", "-ar", "16000", wav_path], 
-            check=True, 
-            stdout=subprocess.DEVNULL 
-        )
-        
-        transcription = stt_model.transcribe(wav_path, language="pl" if language == "pl" else "en")
-        text = transcription["text"].strip()
-
-        emotions = emotion_classifier(wav_path)
-        top_emotion = emotions[0]['label']
+        # Jedno dekodowanie do tablicy NumPy - ta sama tablica trafia do Whispera i Wav2Vec;
+        # STT i emocje liczą się równolegle - czekamy max(STT, emocje) zamiast sumy
+        text, top_emotion, timings = analyze_audio_source(audio_source, language)
 
         # Przekazujemy historię do AI
-        ai_response = generate_gemini_response(text, language=language, emotion=top_emotion, history=history)
+        ai_response, timings["llm_ms"] = timed(
+            generate_gemini_response, text, language=language, emotion=top_emotion,
+            history=session.history, summary=session.summary, priority=PRIORITY_VOICE
+        )
+        timings["total_ms"] = round((time.perf_counter() - request_start) * 1000, 1)
+        remember_turn(session, text, ai_response)
 
         return jsonify({
             "user_text": text,
             "response": ai_response,
-            "emotion_detected": top_emotion
+            "emotion_detected": top_emotion,
+            "timings": timings,
+            "session_id": session.id
         })
     except ApiLimitExceededError:
         return jsonify({
             "error": "API daily limit exceeded",
             "code": "API_DAILY_LIMIT_EXCEEDED"
         }), 429
+    except LlmQueueTimeoutError:
+        return jsonify(LLM_QUEUE_TIMEOUT_ERROR), 503, LLM_QUEUE_TIMEOUT_HEADERS
+    except ModelNotReadyError as e:
+        body, headers = models_loading_error(e)
+        return jsonify(body), 503, headers
+    except NoSpeechError:
+        return jsonify(NO_SPEECH_ERROR), 422
+    except subprocess.TimeoutExpired:
+        logger.error(f"Dekodowanie audio przekroczyło {UPLOAD_DECODE_TIMEOUT}s - FFmpeg zatrzymany")
+        return jsonify(DECODE_TIMEOUT_ERROR), 504
     except subprocess.CalledProcessError as e:
-        logger.error(f"Błąd FFmpeg: {e}")
+        error_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else str(e)
+        logger.error(f"Błąd FFmpeg: {error_msg}")
         return jsonify({"error": "Błąd konwersji audio (FFmpeg)"}), 500
     except FileNotFoundError:
         logger.error("Nie znaleziono programu FFmpeg w systemie!")
         return jsonify({"error": "Serwer nie ma zainstalowanego FFmpeg"}), 500
-    finally:
-        if os.path.exists(webm_path): os.remove(webm_path)
-        if os.path.exists(wav_path): os.remove(wav_path)
+
+# --- ENDPOINT 1b: CZAT TEKSTOWY STRUMIENIOWO (SSE) ---
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    data = read_json_body()
+    if data is None: return jsonify(INVALID_JSON_ERROR), 400
+    user_text = data.get("text")
+    language = data.get("language", "pl")
+
+    if not user_text: return jsonify({"error": "Brak tekstu"}), 400
+
+    session = resolve_session(data.get("session_id"), data.get("history", []))
+    logger.debug(f"📨 Wiadomość tekstowa (stream): '{user_text[:50]}...'")
+    return sse_response(stream_chat_events(user_text, language, None, session))
+
+# --- ENDPOINT 2b: AUDIO STRUMIENIOWO (SSE) ---
+# Najpierw transkrypcja + emocje (zdarzenie "transcription"), potem tokeny odpowiedzi.
+@app.route("/process_audio/stream", methods=["POST"])
+def process_audio_stream():
+    if "audio" not in request.files and not request.form.get("upload_id"): return jsonify({"error": "No audio"}), 400
+
+    language = request.form.get("language", "pl")
+    session = resolve_session(request.form.get("session_id"), parse_history_form())
+    audio_source = read_audio_source()
+    if audio_source is None: return jsonify(UPLOAD_NOT_FOUND), 404
+
+    try:
+        text, top_emotion, timings = analyze_audio_source(audio_source, language)
+    except ModelNotReadyError as e:
+        body, headers = models_loading_error(e)
+        return jsonify(body), 503, headers
+    except NoSpeechError:
+        return jsonify(NO_SPEECH_ERROR), 422
+    except subprocess.TimeoutExpired:
+        logger.error(f"Dekodowanie audio przekroczyło {UPLOAD_DECODE_TIMEOUT}s - FFmpeg zatrzymany")
+        return jsonify(DECODE_TIMEOUT_ERROR), 504
+    except subprocess.CalledProcessError as e:
+        error_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else str(e)
+        logger.error(f"Błąd FFmpeg: {error_msg}")
+        return jsonify({"error": "Błąd konwersji audio (FFmpeg)"}), 500
+    except FileNotFoundError:
+        logger.error("Nie znaleziono programu FFmpeg w systemie!")
+        return jsonify({"error": "Serwer nie ma zainstalowanego FFmpeg"}), 500
+
+    def events():
+        yield sse_event("transcription", {
+            "user_text": text,
+            "emotion_detected": top_emotion,
+            "timings": timings
+        })
+        yield from stream_chat_events(text, language, top_emotion, session, priority=PRIORITY_VOICE)
+
+    return sse_response(events())
+
+# --- ENDPOINT 2b: UPLOAD AUDIO W KAWAŁKACH ---
+@app.route("/upload", methods=["POST"])
+def create_upload():
+    try:
+        upload = chunked_uploads.create()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except FileNotFoundError:
+        logger.error("Nie znaleziono programu FFmpeg w systemie!")
+        return jsonify({"error": "Serwer nie ma zainstalowanego FFmpeg"}), 500
+    body, headers = upload_state(upload)
+    return jsonify(body), 201, headers
+
+@app.route("/upload/<upload_id>", methods=["PATCH"])
+def append_upload(upload_id):
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify(UPLOAD_NOT_FOUND), 404
+    try:
+        # Czytamy ciało kawałkami - dekoder dostaje bajty, zanim cały chunk dotrze
+        with span("upload"):
+            upload.append(
+                parse_upload_offset(request.headers.get("Upload-Offset")),
+                iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b"")
+            )
+    except UploadError as e:
+        body, headers = upload_error_body(e)
+        return jsonify(body), e.status, headers
+    body, headers = upload_state(upload)
+    return jsonify(body), 200, headers
+
+@app.route("/upload/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify(UPLOAD_NOT_FOUND), 404
+    body, headers = upload_state(upload)
+    return jsonify(body), 200, headers
+
+@app.route("/upload/<upload_id>", methods=["DELETE"])
+def delete_upload(upload_id):
+    chunked_uploads.delete(upload_id)
+    return jsonify({"status": "deleted"})
+
+# --- ENDPOINT 2c: RESET SESJI (np. "Nowa rozmowa" w UI) ---
+@app.route("/session/<session_id>", methods=["DELETE"])
+def delete_session(session_id):
+    session_store.delete(session_id)
+    return jsonify({"status": "deleted", "session_id": session_id})
+
+# --- METRYKI I ID ŻĄDANIA ---
+@app.before_request
+def start_request_tracking():
+    g.request_id = metrics.new_request_id(request.headers.get("X-Request-ID"))
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def finish_request_tracking(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # Dla odpowiedzi strumieniowych to czas do wysłania nagłówków (etapy strumienia mierzą spany)
+    metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - g.request_start)
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
 
 # --- ENDPOINT 3: HEALTH CHECK (Wersja Pasywna - Bezpieczna dla limitów) ---
 @app.route("/health", methods=["GET"])
 def health_check():
+    payload, status = health_status()
+    return jsonify(payload), status
+
+def health_status():
+    # Gotowość modeli audio - /chat działa niezależnie od nich
+    models = {
+        "loading_mode": MODEL_LOADING,
+        "backends": {"whisper": STT_BACKEND, "emotion": EMOTION_BACKEND},
+        "audio_ready": audio_models_ready(),
+        **{model.name: model.status() for model in AUDIO_MODELS}
+    }
     # Sprawdzamy tylko, czy klucz API jest wczytany
     if not API_KEY:
-        return jsonify({
+        return {
             "status": "online", 
             "llm_status": "error", 
-            "message": "Missing API Key"
-        }), 500
+            "message": "Missing API Key",
+            "models": models
+        }, 500
     
-    return jsonify({
+    return {
         "status": "online", 
         "llm_status": "ready", 
-        "model": "Gemini Flash Lite (Check skipped to save quota)"
-    }), 200
+        "model": "Gemini Flash Lite (Check skipped to save quota)",
+        "models": models,
+        "piper_pools": {lang: pool.stats() for lang, pool in piper_pools.items()},
+        "tts_cache": tts_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "uploads": chunked_uploads.stats(),
+        "gemini_scheduler": gemini_scheduler.stats(),
+        "worker": {"pid": os.getpid(), "workers": WORKER_COUNT, "torch_threads": TORCH_THREADS},
+        "batching": {
+            "whisper": stt_batcher.stats(),
+            "emotion": emotion_batcher.stats() if EMOTION_BATCHING else None,
+        } if INFERENCE_BATCHING else None
+    }, 200
+
+# --- TTS STRUMIENIOWE (zdanie po zdaniu) ---
+# Dzielimy odpowiedź na zdania i syntezujemy je w tle, a gotowe kawałki audio
+# wysyłamy od razu (chunked HTTP) - pierwsze zdanie gra, zanim reszta jest gotowa.
+_PIPELINE_END = object()
+
+def strip_markdown(text):
+    text = re.sub(r'```.*?```', ' ', text, flags=re.DOTALL)          # bloki kodu
+    text = re.sub(r'!\[[^\]]*\]\([^)]*\)', ' ', text)                # obrazki
+    text = re.sub(r'\[([^\]]+)\]\([^)]*\)', r'\1', text)             # linki -> sam tekst
+    text = re.sub(r'^\s*#{1,6}\s*', '', text, flags=re.MULTILINE)    # nagłówki
+    text = re.sub(r'^\s*([-*+]|\d+[.)])\s+', '', text, flags=re.MULTILINE)  # listy
+    text = re.sub(r'^\s*\|?\s*:?-{3,}.*$', '', text, flags=re.MULTILINE)   # separatory tabel
+    text = text.replace('|', ', ')
+    text = re.sub(r'[*_`~>]+', '', text)                             # pogrubienia, kursywa, cytaty
+    text = re.sub(r'[ \t]+', ' ', text)
+    return re.sub(r' ,', ',', text)
+
+# Skróty, po których kropka nie kończy zdania ("ok. 5 km", "godz. 12", "m.in.", "prof. Nowak")
+SENTENCE_ABBREVIATIONS = {
+    "ok", "godz", "ul", "al", "pl", "np", "tzn", "tj", "tzw", "m.in", "ds", "wg", "jw", "zob", "por", "dr", "prof",
+    "mgr", "inż", "hab", "św", "płk", "gen", "nr", "tel", "str", "ww", "wyd", "maks", "max", "ang", "łac", "e.g",
+    "i.e", "vs", "mr", "mrs", "ms", "st", "approx",
+}
+# Jednostki i skróty zamykające wyliczenie często kończą zdanie ("Kosztuje 5 zł.", "w 2024 r.", "itd.") -
+# tniemy po nich, gdy następny fragment zaczyna się wielką literą
+SENTENCE_END_ABBREVIATIONS = {"zł", "gr", "km", "kg", "min", "tys", "mln", "mld", "r", "w", "itd", "itp", "etc", "no"}
+# Krótsze kawałki doklejamy do następnego zdania - osobno brzmią nienaturalnie ("Tak." / "Jasne!")
+MIN_SENTENCE_CHARS = 12
+
+def ends_with_abbreviation(chunk, next_chunk=""):
+    word = re.search(r'(\S+)\.$', chunk)
+    if not word:
+        return False
+    word = word.group(1).lstrip('(„"\'').lower()
+    if word in SENTENCE_END_ABBREVIATIONS:
+        return not next_chunk.lstrip('(„"\'')[:1].isupper()
+    # Pojedyncza litera to inicjał ("J. Kowalski")
+    return word in SENTENCE_ABBREVIATIONS or (len(word) == 1 and word.isalpha())
+
+def split_into_sentences(text):
+    sentences = []
+    for paragraph in strip_markdown(text).splitlines():
+        pending = ""
+        # Nie tniemy po kropce stojącej za cyfrą (np. "1.", "3. maja" albo "2024.")
+        chunks = re.split(r'(?<=[^\d\s][.!?…])\s+', paragraph)
+        for i, chunk in enumerate(chunks):
+            pending = f"{pending} {chunk}" if pending else chunk
+            next_chunk = chunks[i + 1] if i + 1 < len(chunks) else ""
+            if ends_with_abbreviation(pending, next_chunk) or len(pending.strip(" ,")) < MIN_SENTENCE_CHARS:
+                continue
+            sentences.append(pending)
+            pending = ""
+        if pending:
+            sentences.append(pending)
+    return [sentence.strip(" ,") for sentence in sentences if re.search(r'\w', sentence)]
+
+def pipelined_audio(produce, on_complete=None):
+    """Runs produce(emit, stop) in a background thread and yields emitted chunks as they arrive.
+
+    on_complete receives the whole audio once the producer finished without errors.
+    """
+    chunks = queue.Queue()
+    stop = threading.Event()
+    failed = threading.Event()
+
+    def worker():
+        try:
+            produce(chunks.put, stop)
+        except Exception as e:
+            failed.set()
+            logger.error(f"Błąd strumieniowego TTS: {e}")
+        finally:
+            chunks.put(_PIPELINE_END)
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(worker,), daemon=True, name="tts-pipeline").start()
+    sent = []
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _PIPELINE_END:
+                break
+            sent.append(chunk)
+            yield chunk
+        if on_complete and not failed.is_set():
+            on_complete(b"".join(sent))
+    finally:
+        # Klient się rozłączył albo skończyliśmy - producent przestaje syntezować
+        stop.set()
+
+def edge_sentence_producer(sentences, voice):
+    def produce(emit, stop):
+        async def run():
+            for sentence in sentences:
+                if stop.is_set():
+                    return
+                async for chunk in edge_tts.Communicate(sentence, voice).stream():
+                    if chunk["type"] == "audio":
+                        emit(chunk["data"])
+        with span("tts_edge_stream"):
+            run_async(run())
+    return produce
+
+def wav_header(sample_rate, data_size=0xFFFFFFFF - 36, channels=1, bits=16):
+    # Dla strumienia nie znamy długości - maksymalny rozmiar jest akceptowany przez przeglądarki
+    byte_rate = sample_rate * channels * bits // 8
+    return (
+        b"RIFF" + (data_size + 36).to_bytes(4, "little") + b"WAVE"
+        + b"fmt " + (16).to_bytes(4, "little") + (1).to_bytes(2, "little")
+        + channels.to_bytes(2, "little") + sample_rate.to_bytes(4, "little")
+        + byte_rate.to_bytes(4, "little") + (channels * bits // 8).to_bytes(2, "little")
+        + bits.to_bytes(2, "little")
+        + b"data" + data_size.to_bytes(4, "little")
+    )
+
+@functools.lru_cache(maxsize=None)
+def piper_sample_rate(config_path):
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f)["audio"]["sample_rate"]
+
+def resolve_piper_voice(lang):
+    voice_lang = lang if lang in VOICE_MODELS else "pl"
+    if VOICE_MODELS[voice_lang]["model"].exists():
+        return voice_lang
+    # Fallback do polskiego modelu
+    if voice_lang != "pl" and VOICE_MODELS["pl"]["model"].exists():
+        return "pl"
+    return None
+
+def get_piper_pool(voice_lang):
+    if not POOL_SUPPORTED or PIPER_POOL_SIZES[voice_lang] <= 0:
+        return None
+    with piper_pools_lock:
+        pool = piper_pools.get(voice_lang)
+        if pool is None:
+            voice_data = VOICE_MODELS[voice_lang]
+            pool = PiperPool(
+                PIPER_EXE, voice_data["model"], voice_data["config"],
+                size=PIPER_POOL_SIZES[voice_lang], env=ENV, timeout=PIPER_TIMEOUT
+            )
+            piper_pools[voice_lang] = pool
+        return pool
+
+def piper_synthesize(voice_lang, text, on_chunk=None):
+    """Returns raw 16-bit PCM (or passes it to on_chunk) from the pool or a one-shot Piper process."""
+    pool = get_piper_pool(voice_lang)
+    if pool is not None:
+        return pool.synthesize(text, on_chunk)
+    voice_data = VOICE_MODELS[voice_lang]
+    return synthesize_once(PIPER_EXE, voice_data["model"], voice_data["config"], text, env=ENV, on_chunk=on_chunk)
+
+@atexit.register
+def close_piper_pools():
+    for pool in piper_pools.values():
+        pool.close()
+
+def piper_sentence_producer(sentences, voice_lang):
+    @span("tts_piper_stream")
+    def produce(emit, stop):
+        emit(wav_header(piper_sample_rate(VOICE_MODELS[voice_lang]["config"])))
+        if get_piper_pool(voice_lang) is None:
+            # Bez puli: jeden proces, po jednym zdaniu na linię - Piper wypisuje PCM zdanie po zdaniu
+            piper_synthesize(voice_lang, "\n".join(sentences), on_chunk=emit)
+            return
+        for sentence in sentences:
+            if stop.is_set():
+                break
+            piper_synthesize(voice_lang, sentence, on_chunk=emit)
+    return produce
+
+class TTSRequestError(Exception):
+    """Raised for a /tts request that cannot be served; carries the HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# Formaty wyjściowe TTS: pole "format" (wav | mp3 | opus) albo nagłówek Accept.
+# Bez preferencji zostaje format natywny silnika (Edge: MP3, Piper: WAV) - bez transkodowania.
+NATIVE_TTS_FORMATS = {"edge": "mp3", "piper": "wav"}
+TTS_BITRATES = {
+    "mp3": os.getenv("TTS_MP3_BITRATE", "48k"),
+    "opus": os.getenv("TTS_OPUS_BITRATE", "24k"),
+}
+
+def negotiate_tts_format(model_type, requested, accept):
+    try:
+        return negotiate_format(requested, accept, NATIVE_TTS_FORMATS.get(model_type, "mp3"))
+    except ValueError as e:
+        raise TTSRequestError(str(e))
+
+def tts_cache_prefix(model_type, stream, audio_format):
+    # Format natywny zachowuje dotychczasowe klucze (cache na dysku pozostaje ważny)
+    suffix = "" if audio_format == NATIVE_TTS_FORMATS[model_type] else f":{audio_format}"
+    return f"{model_type}{':stream' if stream else ''}{suffix}"
+
+def resolve_tts_request(text, lang, model_type, stream, audio_format=None):
+    """Picks the voice before synthesis (it is part of the cache key); returns (voice, cache_key, mimetype)."""
+    if not text:
+        raise TTSRequestError("Brak tekstu")
+
+    if model_type == "edge":
+        audio_format = audio_format or NATIVE_TTS_FORMATS["edge"]
+        voice = EDGE_VOICES.get(lang, EDGE_VOICES["pl"])
+        cache_key = tts_cache_key(tts_cache_prefix("edge", stream, audio_format), voice, None, text)
+        if audio_format == NATIVE_TTS_FORMATS["edge"]:
+            return voice, cache_key, 'audio/mpeg' if stream else 'audio/mp3'
+        return voice, cache_key, OUTPUT_FORMATS[audio_format][0]
+
+    if model_type == "piper":
+        if not PIPER_EXE.exists():
+            logger.error(f"❌ Nie znaleziono Pipera: {PIPER_EXE}")
+            raise TTSRequestError("Brak pliku piper.exe na serwerze", 500)
+
+        voice_lang = resolve_piper_voice(lang)
+        if voice_lang is None:
+            raise TTSRequestError("Brak modelu głosu Piper", 500)
+        audio_format = audio_format or NATIVE_TTS_FORMATS["piper"]
+        cache_key = tts_cache_key(
+            tts_cache_prefix("piper", stream, audio_format), VOICE_MODELS[voice_lang]["model"].name,
+            PIPER_LENGTH_SCALE, text
+        )
+        return voice_lang, cache_key, OUTPUT_FORMATS[audio_format][0]
+
+    raise TTSRequestError(f"Nieznany model TTS: {model_type}")
+
+def synthesize_tts(model_type, voice, text, audio_format=None):
+    # === ŚCIEŻKA 1: EDGE TTS (Super Szybka - RAM) ===
+    if model_type == "edge":
+        # Generujemy audio w pamięci RAM (na wspólnej pętli asyncio)
+        with span("tts_edge"):
+            audio = run_async(generate_edge_audio_memory(text, voice)).getvalue()
+
+    # === ŚCIEŻKA 2: PIPER TTS (Lokalny, pula procesów, PCM w RAM) ===
+    else:
+        with span("tts_piper"):
+            pcm = piper_synthesize(voice, text)
+        sample_rate = piper_sample_rate(VOICE_MODELS[voice]["config"])
+        audio = wav_header(sample_rate, len(pcm)) + pcm
+    return encode_tts_audio(audio, model_type, audio_format)
+
+@span("tts_encode")
+def encode_tts_audio(audio, model_type, audio_format):
+    if not audio_format or audio_format == NATIVE_TTS_FORMATS[model_type]:
+        return audio
+    return transcode(audio, audio_format, TTS_BITRATES.get(audio_format))
+
+def tts_stream_producer(model_type, voice, text, audio_format=None):
+    sentences = split_into_sentences(text)
+    if not sentences:
+        return None
+    if model_type == "edge":
+        # Kolejne ramki MP3 można po prostu sklejać - przeglądarka odtwarza je jako jeden strumień
+        produce = edge_sentence_producer(sentences, voice)
+    else:
+        produce = piper_sentence_producer(sentences, voice)
+    if audio_format and audio_format != NATIVE_TTS_FORMATS[model_type]:
+        # FFmpeg koduje w locie - zakodowane strony wychodzą, zanim synteza się skończy
+        produce = transcoding_producer(produce, audio_format, TTS_BITRATES.get(audio_format))
+    return produce
+
+def audio_stream_headers():
+    # Bez ETag - synteza może się przerwać w połowie, a ucięte audio nie może uchodzić za aktualne.
+    # ETag dostaje dopiero kompletne nagranie, gdy wraca z cache.
+    return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-TTS-Cache": "miss", "Vary": "Accept"}
+
+def audio_stream_response(produce, mimetype, cache_key):
+    return Response(
+        stream_with_context(pipelined_audio(produce, on_complete=lambda data: tts_cache.put(cache_key, data))),
+        mimetype=mimetype,
+        headers=audio_stream_headers()
+    )
+
+def is_not_modified(if_none_match, cache_key):
+    # 304 tylko dla nagrań, które serwer naprawdę ma - inaczej potwierdzalibyśmy dowolną (np. uciętą) kopię
+    return if_none_match and tts_cache.contains(cache_key)
+
+def audio_extension(mimetype):
+    return next((ext for mime, ext, _ in OUTPUT_FORMATS.values() if mime == mimetype), '.mp3')
+
+def audio_bytes_response(data, mimetype, cache_key, cache_status):
+    response = send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=False,
+                         download_name='tts' + audio_extension(mimetype),
+                         etag=cache_key, conditional=False)
+    response.headers["X-TTS-Cache"] = cache_status
+    response.headers["Vary"] = "Accept"
+    return response
 
 # --- ENDPOINT 4: TEXT-TO-SPEECH (TTS) ---
 @app.route("/tts", methods=["POST"])
 def tts():
-    data = request.json
+    data = read_json_body()
+    if data is None: return jsonify(INVALID_JSON_ERROR), 400
     text = data.get("text")
     lang = data.get("language", "pl")
     model_type = data.get("model", "edge")
-
-    if not text:
-        return jsonify({"error": "Brak tekstu"}), 400
-
-    # Inicjalizacja zmiennej dla bezpieczeństwa (żeby blok except się nie wywalił)
-    tmp_filename = None
+    # Tryb strumieniowy: audio wysyłane zdanie po zdaniu
+    stream = bool(data.get("stream"))
 
     try:
-        # === ŚCIEŻKA 1: EDGE TTS (Super Szybka - RAM) ===
-        if model_type == "edge":
-            voice = EDGE_VOICES.get(lang, EDGE_VOICES["pl"])
-            # Generujemy audio w pamięci RAM
-            audio_data = asyncio.run(generate_edge_audio_memory(text, voice))
-            return send_file(audio_data, mimetype='audio/mp3', as_attachment=False, download_name='tts.mp3')
-        
-       # === ŚCIEŻKA 2: PIPER TTS (Lokalny, Plikowy) ===
-        elif model_type == "piper":
-            if not PIPER_EXE.exists():
-                logger.error(f"❌ Nie znaleziono Pipera: {PIPER_EXE}")
-                return jsonify({"error": "Brak pliku piper.exe na serwerze"}), 500
-
-            voice_data = VOICE_MODELS.get(lang, VOICE_MODELS["pl"])
-            model_path = voice_data["model"]
-            config_path = voice_data["config"]
-
-            if not model_path.exists():
-                # Fallback do polskiego modelu
-                if lang != "pl" and VOICE_MODELS["pl"]["model"].exists():
-                     model_path = VOICE_MODELS["pl"]["model"]
-                     config_path = VOICE_MODELS["pl"]["config"]
-                else:
-                     return jsonify({"error": f"Brak modelu głosu Piper"}), 500
-
-            # Tworzymy plik tymczasowy TYLKO tutaj
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-                tmp_filename = tmp_file.name
-
-            cmd = [
-                str(PIPER_EXE),
-                "-m", str(model_path),
-                "-c", str(config_path),
-                "-f", str(tmp_filename),
-                "--sentence_silence", "0.2",
-                "--length_scale", "1.0"
-            ]
-            
-            subprocess.run(
-                cmd,
-                input=text.encode("utf-8"),
-                capture_output=True,
-                check=True,
-                env=ENV
-            )
+        audio_format = negotiate_tts_format(model_type, data.get("format"), request.headers.get("Accept"))
+        voice, cache_key, mimetype = resolve_tts_request(text, lang, model_type, stream, audio_format)
+    except TTSRequestError as e:
+        return jsonify({"error": str(e)}), e.status
 
-            with open(tmp_filename, "rb") as f:
-                audio_data = io.BytesIO(f.read())
-            
-            # Sprzątamy plik
-            os.remove(tmp_filename)
-            tmp_filename = None
+    # Klient ma już to nagranie (ETag = adres treści) - nie syntezujemy ani nie wysyłamy ponownie
+    if is_not_modified(request.if_none_match.contains(cache_key), cache_key):
+        tts_cache.record_not_modified()
+        return Response(status=304, headers={"ETag": f'"{cache_key}"'})
 
-            return send_file(audio_data, mimetype='audio/wav', as_attachment=False, download_name='tts.wav')
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        return audio_bytes_response(cached, mimetype, cache_key, "hit")
 
-        else:
-            return jsonify({"error": f"Nieznany model TTS: {model_type}"}), 400
+    if stream:
+        produce = tts_stream_producer(model_type, voice, text, audio_format)
+        if produce is None:
+            return jsonify({"error": "Brak tekstu"}), 400
+        return audio_stream_response(produce, mimetype, cache_key)
 
-    except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else str(e)
+    try:
+        audio_data = synthesize_tts(model_type, voice, text, audio_format)
+        tts_cache.put(cache_key, audio_data)
+        return audio_bytes_response(audio_data, mimetype, cache_key, "miss")
+
+    except PiperError as e:
+        error_msg = str(e)
         logger.error(f"Błąd procesu TTS: {error_msg}")
-        if tmp_filename and os.path.exists(tmp_filename): os.remove(tmp_filename)
         return jsonify({"error": "Błąd generowania TTS", "details": error_msg}), 500
         
     except Exception as e:
         logger.error(f"Błąd ogólny TTS: {e}")
-        if tmp_filename and os.path.exists(tmp_filename): os.remove(tmp_filename)
         return jsonify({"error": str(e)}), 500
     
+# --- TRYB WIELOPROCESOWY (gunicorn, prefork) ---
+# gunicorn.conf.py importuje aplikację w procesie master (preload), więc modele torch są w pamięci
+# przed fork() i workery współdzielą je copy-on-write. Wątki, pule procesów i połączenia
+# nie przechodzą przez fork() - każdy worker tworzy je od nowa tutaj.
+WORKER_COUNT = 1
+
+def init_worker_process(workers):
+    """Re-creates per-process state in a freshly forked worker and splits CPU cores between workers."""
+    global WORKER_COUNT, TORCH_THREADS, inference_executor, client, gemini_scheduler, piper_pools, piper_pools_lock
+    global chunked_uploads
+    WORKER_COUNT = workers
+    if "TORCH_NUM_THREADS" not in os.environ:
+        TORCH_THREADS = max(1, (os.cpu_count() or 2) // (workers * INFERENCE_WORKERS))
+    torch.set_num_threads(TORCH_THREADS)
+    inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+    client = genai.Client(api_key=API_KEY)
+    # Limit RPM dotyczy klucza API, a nie procesu - dzielimy go między workery
+    gemini_scheduler = create_gemini_scheduler(workers)
+    # Procesy Pipera mastera (jeśli były) zostają jego - worker startuje własne przy pierwszym użyciu
+    piper_pools, piper_pools_lock = {}, threading.Lock()
+    session_store.reopen()
+    # Gniazdo nasłuchujące jest wspólne - kawałki jednego uploadu mogą trafić do różnych workerów
+    chunked_uploads = create_upload_store(workers)
+    if MODEL_LOADING == "preload":
+        threading.Thread(target=load_models_in_background, daemon=True, name="model-loading").start()
+    logger.info(f"👷 Worker {os.getpid()} gotowy ({workers} workerów, {TORCH_THREADS} wątków torch)")
+
 if __name__ == '__main__':
     # 1. Sprawdzamy kilka zmiennych charakterystycznych dla Hugging Face
     # HF zawsze ustawia SPACE_ID. Często też ustawia PORT.
@@ -503,11 +1626,7 @@ if __name__ == '__main__':
     # Wymuszamy False, jeśli wykryto Hugging Face.
     debug_mode = not is_hf
     
-    print(f"--- STARTING SERVER ---")
-    print(f"Hugging Face: {is_hf}")
-    print(f"Port: {port}")
-    print(f"Debug: {debug_mode}")
-    print(f"-----------------------")
+    logger.info(f"--- STARTING SERVER --- Hugging Face: {is_hf}, Port: {port}, Debug: {debug_mode}")
     
     # use_reloader=False to krytyczne zabezpieczenie na HF przed błędem "Timed out"
     app.run(host='0.0.0.0', port=port, debug=debug_mode, use_reloader=debug_mode)
\ No newline at end of file
@@ -0,0 +1,625 @@
+# --- TRYB ASGI (asynchroniczny) ---
+# Te same endpointy i kształty JSON co app.py, ale obsługiwane przez jedną pętlę zdarzeń:
+# Gemini przez klienta async (client.aio), Edge TTS natywnie async, a inferencja
+# (FFmpeg, Whisper, Wav2Vec, Piper) w executorach - jeden proces trzyma wiele żądań naraz.
+#
+# Uruchomienie:  uvicorn asgi:app --host 0.0.0.0 --port 7860
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import subprocess
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.datastructures import Headers, MutableHeaders, UploadFile
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import app as backend
+import metrics
+from metrics import span
+from app import (
+    ApiLimitExceededError, LlmQueueTimeoutError, ModelNotReadyError, NoSpeechError, PiperError, TTSRequestError, sse_event
+)
+from rate_limiter import PRIORITY_TEXT, PRIORITY_VOICE
+from uploads import UploadError
+from live_audio import LiveAudio, UtteranceTracker
+
+logger = logging.getLogger(__name__)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+LIMIT_ERROR = {"error": "API daily limit exceeded", "code": "API_DAILY_LIMIT_EXCEEDED"}
+
+
+async def run_blocking(fn, *args):
+    # Praca CPU / blokujące I/O poza pętlą zdarzeń (to_thread przenosi kontekst, m.in. id żądania)
+    return await asyncio.to_thread(fn, *args)
+
+
+# --- GEMINI (klient async) ---
+async def build_request_async(user_text, language, emotion, session, use_cache=True):
+    # Budowanie promptu może utworzyć context cache (wywołanie sieciowe) - robimy to w wątku
+    return await asyncio.to_thread(
+        backend.build_gemini_request, user_text, language, emotion, session.history, session.summary, use_cache
+    )
+
+
+async def generate_gemini_response_async(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    key = backend.first_turn_cache_key(user_text, language, emotion, session.history, session.summary)
+    if key is None:
+        return await call_gemini_async(user_text, language, emotion, session, priority)
+    return await backend.response_cache.get_or_compute_async(
+        key, lambda: call_gemini_async(user_text, language, emotion, session, priority)
+    )
+
+
+async def send_with_prompt_async(send, model, user_text, language, emotion, session):
+    """Async send_with_prompt: builds the prompt for model and awaits send(model, contents, config)."""
+    contents, config, language, cached = await build_request_async(
+        user_text, language, emotion, session, use_cache=model == backend.GEMINI_MODEL
+    )
+    try:
+        return await send(model, contents, config)
+    except Exception as e:
+        if not (cached and backend.is_cache_error(e)):
+            raise
+        backend.invalidate_instruction_cache(language)
+        contents, config, _, _ = await build_request_async(user_text, language, emotion, session, use_cache=False)
+        return await send(model, contents, config)
+
+
+async def call_gemini_async(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    models = backend.client.aio.models
+
+    async def send(model, contents, config):
+        with span("gemini"):
+            return await models.generate_content(model=model, contents=contents, config=config)
+
+    try:
+        response = await backend.gemini_scheduler.run_async(
+            lambda model: send_with_prompt_async(send, model, user_text, language, emotion, session), priority
+        )
+        return backend.clean_response_text(response.text)
+    except Exception as e:
+        backend.raise_gemini_error(e)
+
+
+async def generate_gemini_response_stream_async(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    key = backend.first_turn_cache_key(user_text, language, emotion, session.history, session.summary)
+    cached_reply = backend.response_cache.get(key) if key else None
+    if cached_reply is not None:
+        yield cached_reply
+        return
+    parts = []
+    async for piece in stream_gemini_async(user_text, language, emotion, session, priority):
+        parts.append(piece)
+        yield piece
+    if key:
+        backend.response_cache.put(key, "".join(parts))
+
+
+async def stream_gemini_async(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    models = backend.client.aio.models
+    scrubber = backend.StreamScrubber()
+
+    start = time.perf_counter()
+
+    async def send(model, contents, config):
+        # Ponawiamy tylko do pierwszego fragmentu - potem część odpowiedzi jest już u klienta
+        with span("gemini_first_token"):
+            stream = await models.generate_content_stream(model=model, contents=contents, config=config)
+            return stream, await anext(stream, None)
+
+    try:
+        stream, first_chunk = await backend.gemini_scheduler.run_async(
+            lambda model: send_with_prompt_async(send, model, user_text, language, emotion, session), priority
+        )
+
+        if first_chunk is not None:
+            piece = scrubber.feed(first_chunk.text or "")
+            if piece:
+                yield piece
+            async for chunk in stream:
+                piece = scrubber.feed(chunk.text or "")
+                if piece:
+                    yield piece
+        tail = scrubber.flush()
+        if tail:
+            yield tail
+        metrics.observe_stage("gemini_stream", time.perf_counter() - start)
+    except Exception as e:
+        backend.raise_gemini_error(e)
+
+
+async def chat_events(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    """Yields (event, payload) pairs of a streamed reply - sent as SSE or as WebSocket messages."""
+    parts = []
+    try:
+        async for piece in generate_gemini_response_stream_async(user_text, language, emotion, session, priority):
+            parts.append(piece)
+            yield "delta", {"text": piece}
+        ai_response = "".join(parts)
+        backend.remember_turn(session, user_text, ai_response)
+        yield "done", {"response": ai_response, "emotion_detected": emotion, "session_id": session.id}
+    except ApiLimitExceededError:
+        yield "error", LIMIT_ERROR
+    except LlmQueueTimeoutError:
+        yield "error", backend.LLM_QUEUE_TIMEOUT_ERROR
+    except Exception as e:
+        logger.error(f"Błąd strumienia czatu: {e}")
+        yield "error", {"error": "AI processing error"}
+
+
+async def stream_chat_events(user_text, language, emotion, session, priority=PRIORITY_TEXT):
+    async for event, payload in chat_events(user_text, language, emotion, session, priority):
+        yield sse_event(event, payload)
+
+
+# --- AUDIO ---
+async def read_audio_form(request):
+    """Returns (audio source, language, session) or None without an audio file; the source is the file bytes
+    or a chunked upload (None when upload_id is unknown)."""
+    with span("upload"):
+        form = await request.form()
+        if form.get("upload_id"):
+            audio_source = backend.chunked_uploads.get(form["upload_id"])
+        elif isinstance(form.get("audio"), UploadFile):
+            audio_source = await form["audio"].read()
+        else:
+            return None
+    language = form.get("language", "pl")
+    session = backend.resolve_session(form.get("session_id"), backend.parse_history_json(form.get("history", "[]")))
+    return audio_source, language, session
+
+
+async def analyze_upload(audio_source, language):
+    # analyze_audio sam rozdziela STT i emocje na inference_executor
+    return await run_blocking(backend.analyze_audio_source, audio_source, language)
+
+
+AUDIO_ERRORS = (
+    NoSpeechError, ModelNotReadyError, subprocess.TimeoutExpired, subprocess.CalledProcessError, FileNotFoundError
+)
+
+
+def audio_error_response(e):
+    if isinstance(e, NoSpeechError):
+        return JSONResponse(backend.NO_SPEECH_ERROR, 422)
+    if isinstance(e, ModelNotReadyError):
+        body, headers = backend.models_loading_error(e)
+        return JSONResponse(body, 503, headers=headers)
+    if isinstance(e, subprocess.TimeoutExpired):
+        logger.error(f"Dekodowanie audio przekroczyło {backend.UPLOAD_DECODE_TIMEOUT}s - FFmpeg zatrzymany")
+        return JSONResponse(backend.DECODE_TIMEOUT_ERROR, 504)
+    if isinstance(e, subprocess.CalledProcessError):
+        error_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else str(e)
+        logger.error(f"Błąd FFmpeg: {error_msg}")
+        return JSONResponse({"error": "Błąd konwersji audio (FFmpeg)"}, 500)
+    logger.error("Nie znaleziono programu FFmpeg w systemie!")
+    return JSONResponse({"error": "Serwer nie ma zainstalowanego FFmpeg"}, 500)
+
+
+# --- ENDPOINTY ---
+async def read_json_body(request):
+    """Returns the parsed JSON object or None for a malformed or non-object body."""
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+async def chat(request: Request):
+    data = await read_json_body(request)
+    if data is None:
+        return JSONResponse(backend.INVALID_JSON_ERROR, 400)
+    user_text = data.get("text")
+    language = data.get("language", "pl")
+
+    if not user_text:
+        return JSONResponse({"error": "Brak tekstu"}, 400)
+
+    session = backend.resolve_session(data.get("session_id"), data.get("history", []))
+    try:
+        ai_response = await generate_gemini_response_async(user_text, language, None, session)
+        backend.remember_turn(session, user_text, ai_response)
+        return JSONResponse({"response": ai_response, "emotion_detected": None, "session_id": session.id})
+    except ApiLimitExceededError:
+        return JSONResponse(LIMIT_ERROR, 429)
+    except LlmQueueTimeoutError:
+        return JSONResponse(backend.LLM_QUEUE_TIMEOUT_ERROR, 503, headers=backend.LLM_QUEUE_TIMEOUT_HEADERS)
+    except Exception as e:
+        logger.error(f"Błąd endpointu /chat: {e}")
+        return JSONResponse({"error": "AI processing error"}, 500)
+
+
+async def chat_stream(request: Request):
+    data = await read_json_body(request)
+    if data is None:
+        return JSONResponse(backend.INVALID_JSON_ERROR, 400)
+    user_text = data.get("text")
+    language = data.get("language", "pl")
+
+    if not user_text:
+        return JSONResponse({"error": "Brak tekstu"}, 400)
+
+    session = backend.resolve_session(data.get("session_id"), data.get("history", []))
+    return StreamingResponse(
+        stream_chat_events(user_text, language, None, session), media_type="text/event-stream", headers=SSE_HEADERS
+    )
+
+
+async def process_audio(request: Request):
+    upload = await read_audio_form(request)
+    if upload is None:
+        return JSONResponse({"error": "No audio"}, 400)
+    audio_source, language, session = upload
+    if audio_source is None:
+        return JSONResponse(backend.UPLOAD_NOT_FOUND, 404)
+    request_start = asyncio.get_running_loop().time()
+
+    try:
+        text, top_emotion, timings = await analyze_upload(audio_source, language)
+        llm_start = asyncio.get_running_loop().time()
+        ai_response = await generate_gemini_response_async(text, language, top_emotion, session, PRIORITY_VOICE)
+        now = asyncio.get_running_loop().time()
+        timings["llm_ms"] = round((now - llm_start) * 1000, 1)
+        timings["total_ms"] = round((now - request_start) * 1000, 1)
+        backend.remember_turn(session, text, ai_response)
+
+        return JSONResponse({
+            "user_text": text,
+            "response": ai_response,
+            "emotion_detected": top_emotion,
+            "timings": timings,
+            "session_id": session.id
+        })
+    except ApiLimitExceededError:
+        return JSONResponse(LIMIT_ERROR, 429)
+    except LlmQueueTimeoutError:
+        return JSONResponse(backend.LLM_QUEUE_TIMEOUT_ERROR, 503, headers=backend.LLM_QUEUE_TIMEOUT_HEADERS)
+    except AUDIO_ERRORS as e:
+        return audio_error_response(e)
+
+
+async def process_audio_stream(request: Request):
+    upload = await read_audio_form(request)
+    if upload is None:
+        return JSONResponse({"error": "No audio"}, 400)
+    audio_source, language, session = upload
+    if audio_source is None:
+        return JSONResponse(backend.UPLOAD_NOT_FOUND, 404)
+
+    try:
+        text, top_emotion, timings = await analyze_upload(audio_source, language)
+    except AUDIO_ERRORS as e:
+        return audio_error_response(e)
+
+    async def events():
+        yield sse_event("transcription", {"user_text": text, "emotion_detected": top_emotion, "timings": timings})
+        async for event in stream_chat_events(text, language, top_emotion, session, PRIORITY_VOICE):
+            yield event
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def create_upload(request: Request):
+    try:
+        upload = await run_blocking(backend.chunked_uploads.create)
+    except UploadError as e:
+        return JSONResponse({"error": str(e)}, e.status)
+    except FileNotFoundError as e:
+        return audio_error_response(e)
+    body, headers = backend.upload_state(upload)
+    return JSONResponse(body, 201, headers=headers)
+
+
+async def append_upload(request: Request):
+    upload = backend.chunked_uploads.get(request.path_params["upload_id"])
+    if upload is None:
+        return JSONResponse(backend.UPLOAD_NOT_FOUND, 404)
+    try:
+        offset = backend.parse_upload_offset(request.headers.get("upload-offset"))
+        # Każdy fragment ciała idzie do dekodera od razu (zapis do potoku FFmpeg poza pętlą zdarzeń)
+        with span("upload"):
+            async for chunk in request.stream():
+                if chunk:
+                    offset = await run_blocking(upload.append, offset, [chunk])
+    except UploadError as e:
+        body, headers = backend.upload_error_body(e)
+        return JSONResponse(body, e.status, headers=headers)
+    body, headers = backend.upload_state(upload)
+    return JSONResponse(body, headers=headers)
+
+
+async def upload_status(request: Request):
+    upload = backend.chunked_uploads.get(request.path_params["upload_id"])
+    if upload is None:
+        return JSONResponse(backend.UPLOAD_NOT_FOUND, 404)
+    body, headers = backend.upload_state(upload)
+    return JSONResponse(body, headers=headers)
+
+
+async def delete_upload(request: Request):
+    await run_blocking(backend.chunked_uploads.delete, request.path_params["upload_id"])
+    return JSONResponse({"status": "deleted"})
+
+
+async def delete_session(request: Request):
+    session_id = request.path_params["session_id"]
+    backend.session_store.delete(session_id)
+    return JSONResponse({"status": "deleted", "session_id": session_id})
+
+
+async def metrics_endpoint(request: Request):
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def health_check(request: Request):
+    payload, status = backend.health_status()
+    return JSONResponse(payload, status)
+
+
+def etag_matches(header, cache_key):
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")]
+    return cache_key in tags or "*" in tags
+
+
+def tts_headers(cache_key, cache_status):
+    return {"ETag": f'"{cache_key}"', "X-TTS-Cache": cache_status, "Vary": "Accept"}
+
+
+async def tts(request: Request):
+    data = await read_json_body(request)
+    if data is None:
+        return JSONResponse(backend.INVALID_JSON_ERROR, 400)
+    text = data.get("text")
+    lang = data.get("language", "pl")
+    model_type = data.get("model", "edge")
+    stream = bool(data.get("stream"))
+
+    try:
+        audio_format = backend.negotiate_tts_format(model_type, data.get("format"), request.headers.get("accept"))
+        voice, cache_key, mimetype = backend.resolve_tts_request(text, lang, model_type, stream, audio_format)
+    except TTSRequestError as e:
+        return JSONResponse({"error": str(e)}, e.status)
+
+    if backend.is_not_modified(etag_matches(request.headers.get("if-none-match", ""), cache_key), cache_key):
+        backend.tts_cache.record_not_modified()
+        return Response(status_code=304, headers={"ETag": f'"{cache_key}"'})
+
+    cached = backend.tts_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached, media_type=mimetype, headers=tts_headers(cache_key, "hit"))
+
+    if stream:
+        produce = backend.tts_stream_producer(model_type, voice, text, audio_format)
+        if produce is None:
+            return JSONResponse({"error": "Brak tekstu"}, 400)
+        # pipelined_audio jest generatorem synchronicznym - Starlette iteruje go w puli wątków
+        body = backend.pipelined_audio(produce, on_complete=lambda data: backend.tts_cache.put(cache_key, data))
+        return StreamingResponse(body, media_type=mimetype, headers=backend.audio_stream_headers())
+
+    try:
+        if model_type == "edge":
+            with span("tts_edge"):
+                audio_data = (await backend.generate_edge_audio_memory(text, voice)).getvalue()
+            audio_data = await run_blocking(backend.encode_tts_audio, audio_data, model_type, audio_format)
+        else:
+            audio_data = await run_blocking(backend.synthesize_tts, model_type, voice, text, audio_format)
+        backend.tts_cache.put(cache_key, audio_data)
+        return Response(audio_data, media_type=mimetype, headers=tts_headers(cache_key, "miss"))
+    except PiperError as e:
+        error_msg = str(e)
+        logger.error(f"Błąd procesu TTS: {error_msg}")
+        return JSONResponse({"error": "Błąd generowania TTS", "details": error_msg}, 500)
+    except Exception as e:
+        logger.error(f"Błąd ogólny TTS: {e}")
+        return JSONResponse({"error": str(e)}, 500)
+
+
+# --- TRANSKRYPCJA NA ŻYWO (WebSocket) ---
+# Klient wysyła ramki audio w trakcie mówienia; co STREAM_PARTIAL_INTERVAL_MS Whisper transkrybuje
+# ostatnie STREAM_WINDOW_SECONDS (wynik częściowy), a po STREAM_END_SILENCE_MS ciszy za mową
+# cała wypowiedź idzie do STT + emocji i od razu do Gemini - bez czekania na upload pliku.
+STREAM_PARTIAL_INTERVAL_MS = int(os.getenv("STREAM_PARTIAL_INTERVAL_MS", "1000"))
+STREAM_WINDOW_SECONDS = float(os.getenv("STREAM_WINDOW_SECONDS", "10"))
+STREAM_END_SILENCE_MS = int(os.getenv("STREAM_END_SILENCE_MS", "700"))
+
+
+def audio_error_payload(e):
+    if isinstance(e, NoSpeechError):
+        return backend.NO_SPEECH_ERROR
+    if isinstance(e, ModelNotReadyError):
+        return backend.models_loading_error(e)[0]
+    if isinstance(e, subprocess.TimeoutExpired):
+        return backend.DECODE_TIMEOUT_ERROR
+    if isinstance(e, subprocess.CalledProcessError):
+        return {"error": "Błąd konwersji audio (FFmpeg)"}
+    return {"error": "Serwer nie ma zainstalowanego FFmpeg"}
+
+
+def transcribe_partial(audio, language):
+    # Bez czekania na model - dopóki się ładuje, wyniki częściowe są po prostu pomijane
+    model = backend.stt_loader.get(timeout=0)
+    with span("stt_partial"):
+        return model.transcribe(audio, "pl" if language == "pl" else "en")
+
+
+async def send_partial(send, tracker, audio, language):
+    utterance = tracker.utterance
+    loop = asyncio.get_running_loop()
+    try:
+        text = await loop.run_in_executor(
+            backend.inference_executor, contextvars.copy_context().run, transcribe_partial, audio, language
+        )
+    except ModelNotReadyError:
+        return
+    # Wypowiedź mogła się już skończyć - spóźniony wynik częściowy nie nadpisuje końcowego
+    if text and tracker.utterance == utterance:
+        await send("partial", {"text": text})
+
+
+async def run_voice_turn(send, audio, language, session, previous=None):
+    if previous is not None:
+        # Tury idą po kolei - kolejna odpowiedź potrzebuje w historii poprzedniej
+        await asyncio.wait([previous])
+    if session.id:
+        session = backend.session_store.get(session.id) or session
+    try:
+        text, top_emotion, timings = await run_blocking(backend.analyze_audio, audio, language)
+    except (NoSpeechError, ModelNotReadyError) as e:
+        await send("error", audio_error_payload(e))
+        return
+    await send("transcription", {"user_text": text, "emotion_detected": top_emotion, "timings": timings})
+    async for event, payload in chat_events(text, language, top_emotion, session, PRIORITY_VOICE):
+        await send(event, payload)
+
+
+async def transcribe_socket(websocket: WebSocket):
+    """Protocol: {"type": "start", "language", "session_id", "format": pcm16|webm|ogg} first,
+    then binary audio frames; {"type": "stop"} ends the utterance without waiting for silence."""
+    metrics.new_request_id(websocket.headers.get("x-request-id"))
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+
+    async def send(event, payload):
+        async with send_lock:
+            await websocket.send_json({"type": event, **payload})
+
+    try:
+        start = await websocket.receive_json()
+        if start.get("type") != "start":
+            raise ValueError("First message must be {\"type\": \"start\"}")
+        live = await run_blocking(LiveAudio, start.get("format", "pcm16"), backend.SAMPLE_RATE)
+    except (ValueError, KeyError) as e:
+        await send("error", {"error": str(e)})
+        await websocket.close(1003)
+        return
+    except FileNotFoundError as e:
+        await send("error", audio_error_payload(e))
+        await websocket.close(1011)
+        return
+    except WebSocketDisconnect:
+        return
+
+    language = start.get("language", "pl")
+    # Socket to jedna rozmowa - bez session_id zakładamy sesję, żeby kolejne wypowiedzi miały kontekst
+    session = backend.resolve_session(start.get("session_id") or backend.NEW_SESSION, start.get("history", []))
+    tracker = UtteranceTracker(
+        backend.SAMPLE_RATE, STREAM_PARTIAL_INTERVAL_MS, STREAM_END_SILENCE_MS, backend.MAX_AUDIO_SECONDS,
+        threshold_db=backend.VAD_THRESHOLD_DB, min_speech_ms=backend.VAD_MIN_SPEECH_MS
+    )
+    await send("ready", {"session_id": session.id})
+
+    def feed(data):
+        tracker.append(live.feed(data))
+        return tracker.update()
+
+    def stop():
+        tracker.append(live.flush(timeout=backend.UPLOAD_DECODE_TIMEOUT))
+        return "end" if tracker.has_speech() else "empty"
+
+    partial_task = turn_task = None
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes"):
+                state = await run_blocking(feed, message["bytes"])
+            else:
+                try:
+                    control = json.loads(message.get("text") or "{}")
+                except ValueError:
+                    await send("error", {"error": "Invalid JSON message"})
+                    continue
+                if not isinstance(control, dict) or control.get("type") != "stop":
+                    continue
+                state = await run_blocking(stop)
+
+            if state == "partial" and (partial_task is None or partial_task.done()):
+                # Okno kopiujemy teraz - kolejne ramki zmieniają bufor w wątku roboczym
+                window = tracker.window(STREAM_WINDOW_SECONDS)
+                partial_task = asyncio.create_task(send_partial(send, tracker, window, language))
+            elif state == "end":
+                # Odpowiedź leci w tle - w tym czasie czytamy kolejne ramki (i "stop")
+                turn_task = asyncio.create_task(run_voice_turn(send, tracker.take(), language, session, turn_task))
+            elif state == "empty":
+                tracker.take()
+                await send("error", backend.NO_SPEECH_ERROR)
+    except WebSocketDisconnect:
+        pass
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        await send("error", audio_error_payload(e))
+        await websocket.close(1011)
+    finally:
+        tasks = [task for task in (partial_task, turn_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        live.close()
+
+
+# --- METRYKI I ID ŻĄDANIA ---
+def route_template(scope):
+    # Szablon ścieżki ("/session/{session_id}") zamiast surowego URL - stała liczba serii w metrykach
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return "unmatched"
+
+
+class RequestTrackingMiddleware:
+    """Sets X-Request-ID (also visible in logs) and records request duration per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = metrics.new_request_id(Headers(scope=scope).get("x-request-id"))
+        start = time.perf_counter()
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Request-ID", request_id)
+                metrics.observe_request(
+                    scope["method"], route_template(scope), message["status"], time.perf_counter() - start
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+app = Starlette(
+    routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/chat/stream", chat_stream, methods=["POST"]),
+        Route("/process_audio", process_audio, methods=["POST"]),
+        Route("/process_audio/stream", process_audio_stream, methods=["POST"]),
+        Route("/upload", create_upload, methods=["POST"]),
+        Route("/upload/{upload_id}", append_upload, methods=["PATCH"]),
+        Route("/upload/{upload_id}", upload_status, methods=["GET"]),
+        Route("/upload/{upload_id}", delete_upload, methods=["DELETE"]),
+        Route("/session/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/tts", tts, methods=["POST"]),
+        WebSocketRoute("/ws/transcribe", transcribe_socket),
+    ],
+    middleware=[
+        Middleware(RequestTrackingMiddleware),
+        # Odpowiednik CORS(app, supports_credentials=True) z Flaska
+        Middleware(CORSMiddleware, allow_origin_regex=".*", allow_credentials=True,
+                   allow_methods=["*"], allow_headers=["*"], expose_headers=["ETag", "X-TTS-Cache", "X-Request-ID", "Upload-Offset"]),
+    ],
+)
@@ -0,0 +1,175 @@
+import logging
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Formaty wyjściowe TTS: nazwa -> (mimetype, rozszerzenie, argumenty kodera FFmpeg)
+OUTPUT_FORMATS = {
+    "wav": ("audio/wav", ".wav", ["-c:a", "pcm_s16le", "-f", "wav"]),
+    "mp3": ("audio/mpeg", ".mp3", ["-c:a", "libmp3lame", "-f", "mp3"]),
+    "opus": ("audio/ogg", ".ogg", ["-c:a", "libopus", "-application", "voip", "-f", "ogg"]),
+}
+ACCEPT_ALIASES = {
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav",
+    "audio/mpeg": "mp3", "audio/mp3": "mp3",
+    "audio/ogg": "opus", "audio/opus": "opus",
+}
+READ_CHUNK = 16 * 1024
+
+
+def negotiate_format(requested, accept, native):
+    """Picks the output format: an explicit request field first, then the Accept header, else native.
+
+    Raises ValueError for an unknown requested format; unsupported Accept types fall back to native.
+    """
+    if requested:
+        requested = requested.lower()
+        if requested not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown audio format: {requested} (expected one of {tuple(OUTPUT_FORMATS)})")
+        return requested
+
+    best, best_q = native, 0.0
+    for item in (accept or "").split(","):
+        media_type, *params = [part.strip().lower() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        fmt = native if media_type in ("*/*", "audio/*") else ACCEPT_ALIASES.get(media_type)
+        # Przy równym q wygrywa format natywny (bez transkodowania), potem kolejność w nagłówku
+        if fmt and q > best_q or (fmt == native and q == best_q and q > 0):
+            best, best_q = fmt, q
+    return best
+
+
+def encoder_command(audio_format, bitrate=None):
+    args = list(OUTPUT_FORMATS[audio_format][2])
+    if bitrate and audio_format != "wav":
+        args[2:2] = ["-b:a", bitrate]
+    return ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-ac", "1", *args, "pipe:1"]
+
+
+def transcode(data, audio_format, bitrate=None):
+    """Re-encodes a whole audio file (any format FFmpeg reads) into audio_format."""
+    result = subprocess.run(encoder_command(audio_format, bitrate), input=data, capture_output=True, check=True)
+    return result.stdout
+
+
+class _PipeProcess:
+    """FFmpeg process written through stdin while stdout/stderr are drained by background threads."""
+
+    def __init__(self, cmd, on_output):
+        self.cmd = cmd
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stderr = []
+        self._threads = [
+            threading.Thread(target=self._drain, args=(self.process.stdout, on_output), daemon=True),
+            threading.Thread(target=self._drain, args=(self.process.stderr, self._stderr.append), daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @staticmethod
+    def _drain(pipe, sink):
+        for chunk in iter(lambda: pipe.read1(READ_CHUNK), b""):
+            sink(chunk)
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # FFmpeg skończył wcześniej (np. limit -t albo błąd danych) - błąd zgłosi close()
+            pass
+
+    def close(self, timeout=None):
+        """Closes stdin, waits for all output; raises CalledProcessError on a non-zero exit
+        and TimeoutExpired (after killing the process) when it does not finish in time."""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        # Jeden termin na całość - każde czekanie dostaje tylko to, co z niego zostało
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        for thread in self._threads:
+            thread.join(remaining())
+        try:
+            returncode = self.process.wait(remaining())
+        except subprocess.TimeoutExpired:
+            self.kill()
+            raise
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, self.cmd, stderr=b"".join(self._stderr))
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def transcoding_producer(produce, audio_format, bitrate=None):
+    """Wraps a streaming TTS producer(emit, stop) so its audio leaves re-encoded, chunk by chunk."""
+    def transcode_stream(emit, stop):
+        encoder = _PipeProcess(encoder_command(audio_format, bitrate), emit)
+        try:
+            produce(encoder.write, stop)
+        except BaseException:
+            encoder.kill()
+            raise
+        encoder.close()
+    return transcode_stream
+
+
+class StreamingDecoder:
+    """Decodes audio to mono float32 PCM while it is being uploaded: feed() bytes as they arrive,
+    finish() returns the samples once the rest of the stream has been decoded.
+
+    Live streams (max_seconds=None) can also read() the samples decoded so far.
+    """
+
+    def __init__(self, sample_rate=16000, max_seconds=60):
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "f32le", "-acodec", "pcm_f32le",
+            "-ac", "1", "-ar", str(sample_rate),
+            *(["-t", str(max_seconds)] if max_seconds else []),
+            "pipe:1"
+        ]
+        self._pcm = []
+        self._remainder = b""
+        self._lock = threading.Lock()
+        self._pipe = _PipeProcess(cmd, self._on_pcm)
+
+    def _on_pcm(self, chunk):
+        with self._lock:
+            self._pcm.append(chunk)
+
+    def feed(self, data):
+        self._pipe.write(data)
+
+    def read(self):
+        """Returns the samples decoded since the previous read() and forgets them."""
+        with self._lock:
+            pcm, self._pcm = self._remainder + b"".join(self._pcm), []
+            # Wyrównanie do pełnych próbek float32 - reszta czeka na następny odczyt
+            usable = len(pcm) // 4 * 4
+            self._remainder = pcm[usable:]
+        return np.frombuffer(pcm[:usable], dtype=np.float32).copy()
+
+    def finish(self, timeout=None):
+        self._pipe.close(timeout)
+        return self.read()
+
+    def abort(self):
+        self._pipe.kill()
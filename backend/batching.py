@@ -0,0 +1,105 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def split_by_padding(items, max_pad, size_of=len):
+    """Splits items sorted by size into runs in which no item is padded by more than max_pad
+    (a fraction of the run's longest item)."""
+    runs = []
+    for item in items:
+        if runs and size_of(item) * (1 - max_pad) <= size_of(runs[-1][0]):
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    return runs
+
+
+class MicroBatcher:
+    """Collects concurrent inference requests into batches and resolves a Future per request.
+
+    A batch is closed when it reaches max_batch items or max_wait_ms after its first item.
+    Items are then grouped by key (e.g. language) and sorted by size, so each forward pass
+    gets clips of similar duration and padding stays small.
+    """
+
+    def __init__(self, name, run_batch, max_batch=8, max_wait_ms=20, size_of=len):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.size_of = size_of
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item, key=None):
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((key, item, future))
+        return future
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+            "queued": self._queue.qsize(),
+        }
+
+    def _ensure_worker(self):
+        # Wątek startuje leniwie (i ponownie po forku - wątki nie przechodzą do procesu potomnego)
+        with self._lock:
+            if self._worker_pid != os.getpid():
+                self._worker_pid = os.getpid()
+                threading.Thread(target=self._loop, daemon=True, name=f"batcher-{self.name}").start()
+
+    def _collect(self):
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _loop(self):
+        while True:
+            pending = self._collect()
+            groups = {}
+            for entry in pending:
+                groups.setdefault(entry[0], []).append(entry)
+            for key, entries in groups.items():
+                # Bucketing po długości - podobne klipy w jednej paczce
+                entries.sort(key=lambda entry: self.size_of(entry[1]))
+                self._run(key, entries)
+
+    def _run(self, key, entries):
+        entries = [entry for entry in entries if entry[2].set_running_or_notify_cancel()]
+        if not entries:
+            return
+        try:
+            results = self.run_batch([item for _, item, _ in entries], key)
+        except Exception as e:
+            logger.error(f"Błąd paczki inferencji '{self.name}' ({len(entries)} elem.): {e}")
+            for _, _, future in entries:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(entries)
+        completed_at = time.perf_counter()
+        for (_, _, future), result in zip(entries, results):
+            # Znacznik przed set_result - wołający liczy z niego czas etapu (razem z czekaniem w kolejce)
+            future.completed_at = completed_at
+            future.set_result(result)
@@ -0,0 +1,372 @@
+# --- BENCHMARK / GENERATOR OBCIĄŻENIA ---
+# Uruchamia backend w tym samym procesie (Flask albo ASGI) na lokalnym porcie, podmienia Gemini
+# i Edge TTS na lokalne atrapy o stałym opóźnieniu i strzela prawdziwymi żądaniami HTTP
+# z zadaną współbieżnością. Wynik (p50/p95/p99, przepustowość, szczytowe RSS) to JSON
+# do porównywania między commitami.
+#
+#   python benchmark.py --concurrency 4 --requests 40 --output bench.json
+#   python benchmark.py --server asgi --scenarios chat,tts_edge --llm-latency-ms 500
+#   python benchmark.py --fixtures fixtures/audio      # prawdziwe nagrania zamiast syntetycznych
+#
+# Wymaga FFmpeg (dekodowanie audio) oraz - dla scenariusza tts_piper - Pipera z modelem głosu.
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE = Path(__file__).resolve().parent
+SCENARIOS = ("health", "chat", "process_audio", "tts_edge", "tts_piper")
+SYNTHETIC_CLIP_SECONDS = (1.5, 4, 10, 25)
+
+REPLY = (
+    "Kraków to świetny wybór na weekend! Warto zacząć od Rynku Głównego i Sukiennic, "
+    "a potem przejść na Wawel. Wieczorem polecam Kazimierz i tamtejsze restauracje."
+)
+TTS_TEXT = "Warto zacząć od Rynku Głównego i Sukiennic. Wieczorem polecam Kazimierz i tamtejsze restauracje."
+
+
+# --- ATRAPY GEMINI I EDGE TTS ---
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiModels:
+    """Stands in for client.models / client.aio.models: fixed latency, canned reply."""
+
+    def __init__(self, latency, chunks=6):
+        self.latency = latency
+        self.chunks = chunks
+
+    def _pieces(self):
+        size = -(-len(REPLY) // self.chunks)
+        return [REPLY[i:i + size] for i in range(0, len(REPLY), size)]
+
+    def generate_content(self, model, contents, config):
+        time.sleep(self.latency)
+        return FakeResponse(REPLY)
+
+    def generate_content_stream(self, model, contents, config):
+        time.sleep(self.latency / 2)
+        for piece in self._pieces():
+            yield FakeResponse(piece)
+            time.sleep(self.latency / 2 / self.chunks)
+
+
+class FakeAsyncGeminiModels(FakeGeminiModels):
+    async def generate_content(self, model, contents, config):
+        await asyncio.sleep(self.latency)
+        return FakeResponse(REPLY)
+
+    async def generate_content_stream(self, model, contents, config):
+        async def stream():
+            await asyncio.sleep(self.latency / 2)
+            for piece in self._pieces():
+                yield FakeResponse(piece)
+                await asyncio.sleep(self.latency / 2 / self.chunks)
+        return stream()
+
+
+def fake_edge_communicate(latency, bytes_per_char=200):
+    class FakeCommunicate:
+        def __init__(self, text, voice):
+            self.size = max(1, len(text)) * bytes_per_char
+
+        async def stream(self):
+            await asyncio.sleep(latency)
+            for start in range(0, self.size, 4096):
+                yield {"type": "audio", "data": b"\xff" * min(4096, self.size - start)}
+    return FakeCommunicate
+
+
+# --- NAGRANIA TESTOWE ---
+def synthetic_clip(seconds, sample_rate=16000, seed=0):
+    """Speech-like test signal: voiced 'syllables' with pauses over low background noise, as WAV bytes."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)          # ~4 sylaby na sekundę
+    phrases = (np.sin(2 * np.pi * 0.3 * t) > -0.6).astype(float)     # co kilka sekund pauza
+    signal = 0.2 * voiced * syllables * phrases + 0.002 * rng.standard_normal(len(t))
+    pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def load_clips(fixtures_dir):
+    if fixtures_dir:
+        paths = sorted(p for p in Path(fixtures_dir).iterdir() if p.is_file())
+        return [(p.stem, p.name, p.read_bytes()) for p in paths]
+    return [(f"{s}s", f"synthetic_{s}s.wav", synthetic_clip(s, seed=i)) for i, s in enumerate(SYNTHETIC_CLIP_SECONDS)]
+
+
+# --- SERWER W TYM SAMYM PROCESIE ---
+def prepare_backend(args):
+    # Zmienne środowiskowe muszą być ustawione PRZED importem app (czyta je przy imporcie)
+    os.environ.setdefault("MODEL_LOADING", "eager")
+    os.environ["GEMINI_API_KEY"] = "benchmark"
+    os.environ["GEMINI_CONTEXT_CACHE"] = "0"
+    os.environ["SESSION_BACKEND"] = "memory"
+    # Fałszywy Gemini nie ma limitów - token bucket zaniżałby przepustowość
+    os.environ.setdefault("GEMINI_RPM", "0")
+    # Ten sam klip i tekst w każdym żądaniu - cache pierwszej tury pomijałby krok LLM po pierwszym żądaniu
+    os.environ["GEMINI_RESPONSE_CACHE"] = "0"
+    if not args.tts_cache:
+        os.environ["TTS_CACHE_MAX_MB"] = "0"
+        os.environ.pop("TTS_CACHE_DIR", None)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, str(BASE))
+
+    import edge_tts
+    edge_tts.Communicate = fake_edge_communicate(args.edge_latency_ms / 1000)
+
+    import app as backend
+    backend.client = SimpleNamespace(
+        models=FakeGeminiModels(args.llm_latency_ms / 1000),
+        aio=SimpleNamespace(models=FakeAsyncGeminiModels(args.llm_latency_ms / 1000)),
+    )
+    return backend
+
+
+def start_server(backend, kind):
+    if kind == "flask":
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)  # bez linii logu na każde żądanie
+        server = make_server("127.0.0.1", 0, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{server.server_port}"
+
+    import socket
+    import uvicorn
+    import asgi
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None  # serwer nie działa w głównym wątku
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+# --- ŻĄDANIA ---
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, content_type) in files.items():
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n".encode()
+        )
+        body.write(data + b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+def json_request(path, payload):
+    return path, json.dumps(payload).encode(), "application/json"
+
+
+def scenario_requests(name, clip=None):
+    """Returns a factory i -> (path, body, content_type); body None means GET."""
+    if name == "health":
+        return lambda i: ("/health", None, None)
+    if name == "chat":
+        return lambda i: json_request("/chat", {"text": f"Gdzie pojechać na weekend? ({i})", "language": "pl"})
+    if name == "process_audio":
+        _, filename, data = clip
+        content_type = "audio/wav" if filename.endswith(".wav") else "application/octet-stream"
+
+        def build(i):
+            body, multipart_type = multipart({"language": "pl"}, {"audio": (filename, data, content_type)})
+            return "/process_audio", body, multipart_type
+        return build
+    model = name.split("_", 1)[1]
+    # Numer w tekście - każde żądanie to nowa synteza, a nie trafienie w cache
+    return lambda i: json_request("/tts", {"text": f"{TTS_TEXT} {i}.", "language": "pl", "model": model})
+
+
+def send(base_url, path, body, content_type, timeout):
+    request = urllib.request.Request(base_url + path, data=body, method="POST" if body is not None else "GET")
+    if content_type:
+        request.add_header("Content-Type", content_type)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return status, (time.perf_counter() - start) * 1000
+
+
+def peak_rss_mb():
+    # Serwer działa w tym procesie - to szczyt pamięci backendu (bez FFmpeg/Pipera w procesach potomnych)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux raportuje KB, macOS bajty
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def stage_means(before, after):
+    means = {}
+    for labels, (count, total) in after.items():
+        prev_count, prev_total = before.get(labels, (0, 0.0))
+        if count > prev_count:
+            means[labels[0]] = round((total - prev_total) / (count - prev_count) * 1000, 1)
+    return dict(sorted(means.items()))
+
+
+def run_scenario(base_url, build, args, stage_totals):
+    for i in range(args.warmup):
+        send(base_url, *build(-1 - i), args.timeout)
+
+    before = stage_totals()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda i: send(base_url, *build(i), args.timeout), range(args.requests)))
+    wall = time.perf_counter() - start
+
+    latencies = np.array([ms for status, ms in results if 200 <= status < 300])
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {
+        "requests": len(results),
+        "ok": int(len(latencies)),
+        "status_codes": statuses,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "server_stage_mean_ms": stage_means(before, stage_totals()),
+    }
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report.update({
+            "p50_ms": round(p50, 1), "p95_ms": round(p95, 1), "p99_ms": round(p99, 1),
+            "mean_ms": round(latencies.mean(), 1), "max_ms": round(latencies.max(), 1),
+        })
+    return report
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain"], cwd=BASE, capture_output=True, text=True)
+        return revision.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend endpoints with stand-ins for Gemini and Edge TTS.")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {SCENARIOS}")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per scenario")
+    parser.add_argument("--fixtures", help="directory with audio clips (default: synthetic clips of varying length)")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--edge-latency-ms", type=float, default=150)
+    parser.add_argument("--tts-cache", action="store_true", help="keep the TTS cache enabled")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {sorted(unknown)}")
+
+    load_start = time.perf_counter()
+    backend = prepare_backend(args)
+    base_url = start_server(backend, args.server)
+    startup_s = time.perf_counter() - load_start
+    stage_totals = backend.metrics.STAGE_SECONDS.totals
+
+    results = {}
+    for name in scenarios:
+        if name == "tts_piper" and (not backend.PIPER_EXE.exists() or backend.resolve_piper_voice("pl") is None):
+            results[name] = {"skipped": "Piper binary or voice model not found"}
+            continue
+        if name == "process_audio":
+            for label, filename, data in load_clips(args.fixtures):
+                print(f"⏱️ process_audio [{label}]...", file=sys.stderr)
+                results[f"process_audio[{label}]"] = run_scenario(
+                    base_url, scenario_requests(name, (label, filename, data)), args, stage_totals
+                )
+            continue
+        print(f"⏱️ {name}...", file=sys.stderr)
+        results[name] = run_scenario(base_url, scenario_requests(name), args, stage_totals)
+
+    report = {
+        "meta": {
+            "git": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "server": args.server,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "llm_latency_ms": args.llm_latency_ms,
+            "edge_latency_ms": args.edge_latency_ms,
+            "tts_cache": args.tts_cache,
+            "startup_s": round(startup_s, 2),
+            "env": {
+                key: os.environ[key] for key in sorted(os.environ)
+                if key.split("_")[0] in ("MODEL", "STT", "EMOTION", "INFERENCE", "BATCH", "TORCH", "PIPER", "VAD", "MAX")
+            },
+        },
+        "scenarios": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+        print(f"✅ Zapisano {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# --- EKSPORT I WERYFIKACJA ZOPTYMALIZOWANYCH MODELI ---
+# Jednorazowa konwersja modeli do backendów STT_BACKEND=ctranslate2 / EMOTION_BACKEND=onnx
+# oraz porównanie dowolnego backendu z referencyjnym fp32 (torch) na zestawie nagrań.
+#
+#   python export_models.py export                 # oba modele do backend/models/
+#   python export_models.py check fixtures/audio --stt-backend ctranslate2 --emotion-backend onnx
+#   python export_models.py check fixtures/audio --emotion-backend torch --emotion-batch 8   # EMOTION_BATCHING
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import torch
+import whisper
+
+from batching import split_by_padding
+from inference_backends import (
+    EMOTION_BACKENDS, EMOTION_MODEL, EMOTION_ONNX_DIR, STT_BACKENDS, WHISPER_CT2_DIR, WHISPER_HF_MODEL,
+    load_emotion, load_stt,
+)
+
+AUDIO_EXTENSIONS = {".wav", ".webm", ".ogg", ".mp3", ".m4a", ".flac"}
+
+
+def export_whisper():
+    from ctranslate2.converters import TransformersConverter
+
+    print(f"⏳ Konwersja {WHISPER_HF_MODEL} -> CTranslate2 int8 ({WHISPER_CT2_DIR})...")
+    converter = TransformersConverter(WHISPER_HF_MODEL, copy_files=["tokenizer.json", "preprocessor_config.json"])
+    converter.convert(str(WHISPER_CT2_DIR), quantization="int8", force=True)
+    print("✅ Whisper (CTranslate2) gotowy")
+
+
+def export_emotion():
+    from optimum.onnxruntime import ORTModelForAudioClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoFeatureExtractor
+
+    print(f"⏳ Eksport {EMOTION_MODEL} -> ONNX + kwantyzacja int8 ({EMOTION_ONNX_DIR})...")
+    model = ORTModelForAudioClassification.from_pretrained(EMOTION_MODEL, export=True)
+    model.save_pretrained(EMOTION_ONNX_DIR)
+    AutoFeatureExtractor.from_pretrained(EMOTION_MODEL).save_pretrained(EMOTION_ONNX_DIR)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=EMOTION_ONNX_DIR,
+        quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False),
+    )
+    print("✅ Emocje (ONNX int8) gotowe")
+
+
+def word_error_rate(reference, hypothesis):
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    # Odległość edycyjna na poziomie słów, jeden wiersz tablicy DP naraz
+    row = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        prev, row[0] = row[0], i
+        for j, hyp_word in enumerate(hyp, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ref_word != hyp_word))
+    return row[-1] / len(ref)
+
+
+def run_backend(stt, classifier, clips, language):
+    transcripts, labels = [], []
+    start = time.perf_counter()
+    for audio in clips:
+        transcripts.append(stt.transcribe(audio, language))
+        labels.append(classifier(audio)[0]["label"])
+    return transcripts, labels, time.perf_counter() - start
+
+
+def batched_labels(classifier, clips, batch_size, max_pad):
+    """Labels clips the way EMOTION_BATCHING does: sorted by length, split into runs with bounded padding."""
+    order = sorted(range(len(clips)), key=lambda i: len(clips[i]))
+    labels = [None] * len(clips)
+    for start in range(0, len(order), batch_size):
+        chunk = order[start:start + batch_size]
+        for run in split_by_padding(chunk, max_pad, size_of=lambda i: len(clips[i])):
+            results = classifier([clips[i] for i in run], batch_size=len(run))
+            for i, emotions in zip(run, results):
+                labels[i] = emotions[0]["label"]
+    return labels
+
+
+def check(args):
+    paths = sorted(p for p in Path(args.fixtures).iterdir() if p.suffix.lower() in AUDIO_EXTENSIONS)
+    if not paths:
+        sys.exit(f"Brak nagrań w {args.fixtures}")
+    torch.set_num_threads(args.threads)
+    # whisper.load_audio dekoduje przez FFmpeg do 16 kHz mono float32 - tak samo jak decode_audio_bytes w app.py
+    clips = [whisper.load_audio(str(p)) for p in paths]
+    audio_seconds = sum(len(c) for c in clips) / whisper.audio.SAMPLE_RATE
+
+    print("⏳ Referencja: torch fp32...")
+    ref_text, ref_labels, ref_time = run_backend(load_stt("torch"), load_emotion("torch"), clips, args.language)
+    print(f"⏳ Kandydat: STT={args.stt_backend}, emocje={args.emotion_backend}...")
+    stt, classifier = load_stt(args.stt_backend, args.threads), load_emotion(args.emotion_backend, args.threads)
+    run_backend(stt, classifier, clips[:1], args.language)  # rozgrzewka, poza pomiarem
+    text, labels, elapsed = run_backend(stt, classifier, clips, args.language)
+
+    if args.emotion_batch > 1:
+        # Referencja zostaje klip po klipie - z --emotion-backend torch różnica to wyłącznie efekt paczek
+        print(f"⏳ Emocje w paczkach po {args.emotion_batch} (max dopełnienie {args.emotion_batch_max_pad})...")
+        labels = batched_labels(classifier, clips, args.emotion_batch, args.emotion_batch_max_pad)
+
+    wers = [word_error_rate(r, h) for r, h in zip(ref_text, text)]
+    agreement = sum(r == h for r, h in zip(ref_labels, labels)) / len(clips)
+    report = {
+        "clips": len(clips),
+        "audio_seconds": round(audio_seconds, 1),
+        "stt_backend": args.stt_backend,
+        "emotion_backend": args.emotion_backend,
+        "emotion_batch": args.emotion_batch,
+        "wer_vs_fp32": round(sum(wers) / len(wers), 4),
+        "emotion_agreement": round(agreement, 4),
+        "fp32_rtf": round(ref_time / audio_seconds, 4),
+        "candidate_rtf": round(elapsed / audio_seconds, 4),
+        "speedup": round(ref_time / elapsed, 2),
+        "per_clip": [
+            {"file": p.name, "wer": round(w, 4), "fp32": r, "candidate": h, "emotion": [rl, hl]}
+            for p, w, r, h, rl, hl in zip(paths, wers, ref_text, text, ref_labels, labels)
+        ],
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if report["wer_vs_fp32"] > args.max_wer or agreement < args.min_agreement:
+        print(f"❌ Poza progami (max WER {args.max_wer}, min zgodność emocji {args.min_agreement})")
+        sys.exit(1)
+    print("✅ Wyniki zgodne z fp32 w granicach progów")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export optimized STT/emotion models and check them against fp32.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_cmd = commands.add_parser("export", help="convert models for the ctranslate2/onnx backends")
+    export_cmd.add_argument("--stt", action="store_true", help="only Whisper -> CTranslate2")
+    export_cmd.add_argument("--emotion", action="store_true", help="only wav2vec2 -> ONNX int8")
+
+    check_cmd = commands.add_parser("check", help="compare a backend with torch fp32 on a fixture set")
+    check_cmd.add_argument("fixtures", help="directory with audio clips")
+    check_cmd.add_argument("--stt-backend", choices=STT_BACKENDS, default="torch-int8")
+    check_cmd.add_argument("--emotion-backend", choices=EMOTION_BACKENDS, default="torch-int8")
+    check_cmd.add_argument("--language", default="pl")
+    check_cmd.add_argument("--threads", type=int, default=torch.get_num_threads())
+    check_cmd.add_argument("--max-wer", type=float, default=0.10)
+    check_cmd.add_argument("--min-agreement", type=float, default=0.90)
+    check_cmd.add_argument("--emotion-batch", type=int, default=1, help="classify emotions in batches of N")
+    check_cmd.add_argument("--emotion-batch-max-pad", type=float, default=0.05)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        both = not (args.stt or args.emotion)
+        if args.stt or both:
+            export_whisper()
+        if args.emotion or both:
+            export_emotion()
+    else:
+        check(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# --- TRYB WIELOPROCESOWY (gunicorn) ---
+# Kilka workerów na jednym węźle bez kopiowania modeli do każdego procesu:
+# master importuje aplikację (preload), ładuje Whisper i Wav2Vec raz, a fork() daje
+# workerom te same strony pamięci (copy-on-write). Rdzenie CPU dzielone są między workery.
+#
+# Uruchomienie (z katalogu backend):
+#   gunicorn -c gunicorn.conf.py               # Flask (wątki)
+#   SERVER_MODE=asgi gunicorn -c gunicorn.conf.py  # Starlette (uvicorn worker)
+import gc
+import os
+import tempfile
+
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+
+if SERVER_MODE == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+elif SERVER_MODE == "wsgi":
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
+else:
+    raise ValueError(f"Unknown SERVER_MODE: {SERVER_MODE}")
+
+# Wątki ładowania w tle nie przeżywają fork() - zamiast "background" modele idą do mastera.
+# MODEL_LOADING=lazy zostaje (każdy worker ładuje własną kopię przy pierwszym użyciu).
+if os.getenv("MODEL_LOADING") != "lazy":
+    os.environ["MODEL_LOADING"] = "preload"
+# Pamięć sesji w procesie nie jest widoczna dla innych workerów - domyślnie wspólny plik SQLite
+os.environ.setdefault("SESSION_BACKEND", "sqlite")
+# SQLite (WAL) potrzebuje zapisu w katalogu bazy - gdy katalog aplikacji jest tylko do odczytu
+# (np. kontener bez uprawnień do /app), baza trafia do katalogu tymczasowego
+if "SESSION_DB_PATH" not in os.environ and not os.access(os.path.dirname(os.path.abspath(__file__)), os.W_OK):
+    os.environ["SESSION_DB_PATH"] = os.path.join(tempfile.gettempdir(), "sessions.db")
+# Tokenizery HF z własnymi wątkami ostrzegają (i potrafią się zawiesić) po fork()
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def when_ready(server):
+    # Obiekty z preloadu trafiają do stałej generacji - GC w workerach nie dotyka ich stron pamięci
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+
+    app.init_worker_process(server.cfg.workers)
@@ -0,0 +1,132 @@
+import logging
+from pathlib import Path
+
+import torch
+import whisper
+from transformers import AutoFeatureExtractor, pipeline
+
+# --- OPCJONALNE BACKENDY (instalowane osobno) ---
+try:
+    import faster_whisper
+except ImportError:
+    faster_whisper = None
+
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForAudioClassification
+except ImportError:
+    onnxruntime = None
+    ORTModelForAudioClassification = None
+
+logger = logging.getLogger(__name__)
+
+WHISPER_MODEL = "base"
+WHISPER_HF_MODEL = "openai/whisper-base"
+EMOTION_MODEL = "superb/wav2vec2-base-superb-er"
+
+STT_BACKENDS = ("torch", "torch-int8", "ctranslate2")
+EMOTION_BACKENDS = ("torch", "torch-int8", "onnx")
+# Backendy, których model można załadować przed fork() i współdzielić między workerami.
+# torch-int8 nie: quantize_dynamic w masterze zostawia stan kwantyzacji i pule wątków torch,
+# których bezpieczeństwa po fork() nic nie sprawdza - ten wariant każdy worker ładuje sam.
+FORK_SAFE_BACKENDS = ("torch",)
+
+MODELS_DIR = Path(__file__).resolve().parent / "models"
+WHISPER_CT2_DIR = MODELS_DIR / "whisper-base-ct2"
+EMOTION_ONNX_DIR = MODELS_DIR / "emotion-onnx"
+EMOTION_ONNX_FILE = "model_quantized.onnx"
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of all Linear layers (weights int8, activations quantized per call)."""
+    logger.info(f"🧮 Kwantyzacja int8: {type(model).__name__}")
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class WhisperSTT:
+    """openai-whisper model (fp32 or int8) behind the common transcribe / transcribe_batch interface."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def transcribe(self, audio, language):
+        return self.model.transcribe(audio, language=language)["text"].strip()
+
+    def transcribe_batch(self, audios, language):
+        # Klipy do 30 s dekodujemy jedną paczką spektrogramów (Whisper i tak dopełnia je do 30 s)
+        texts = [None] * len(audios)
+        short = [i for i, audio in enumerate(audios) if len(audio) <= whisper.audio.N_SAMPLES]
+        if short:
+            mels = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audios[i])), n_mels=self.model.dims.n_mels)
+                for i in short
+            ]).to(self.model.device)
+            options = whisper.DecodingOptions(language=language, fp16=False, without_timestamps=True)
+            for i, result in zip(short, whisper.decode(self.model, mels, options)):
+                texts[i] = result.text.strip()
+        # Dłuższe nagrania - zwykłe transcribe z przesuwanym oknem
+        for i, audio in enumerate(audios):
+            if texts[i] is None:
+                texts[i] = self.transcribe(audio, language)
+        return texts
+
+
+class CTranslate2STT:
+    """faster-whisper (CTranslate2, int8) behind the same interface as WhisperSTT."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def transcribe(self, audio, language):
+        # beam_size=1 - zachłanne dekodowanie, jak domyślnie w openai-whisper
+        segments, _ = self.model.transcribe(audio, language=language, beam_size=1)
+        return "".join(segment.text for segment in segments).strip()
+
+    def transcribe_batch(self, audios, language):
+        return [self.transcribe(audio, language) for audio in audios]
+
+
+def load_stt(backend="torch", num_threads=0):
+    if backend not in STT_BACKENDS:
+        raise ValueError(f"Unknown STT backend: {backend} (expected one of {STT_BACKENDS})")
+    if backend == "ctranslate2":
+        if faster_whisper is None:
+            raise RuntimeError("STT backend 'ctranslate2' needs: pip install faster-whisper")
+        if not WHISPER_CT2_DIR.exists():
+            raise RuntimeError(f"Missing {WHISPER_CT2_DIR} - run: python export_models.py export --stt")
+        model = faster_whisper.WhisperModel(str(WHISPER_CT2_DIR), device="cpu", compute_type="int8", cpu_threads=num_threads)
+        return CTranslate2STT(model)
+
+    # Modele int8 z quantize_dynamic liczą tylko na CPU
+    model = whisper.load_model(WHISPER_MODEL, device="cpu" if backend == "torch-int8" else None)
+    if backend == "torch-int8":
+        # whisper.model.Linear nadpisuje tylko forward (rzutowanie dtype pod fp16) - na CPU w fp32
+        # to zwykły nn.Linear, a quantize_dynamic podmienia wyłącznie dokładny typ nn.Linear
+        for module in model.modules():
+            if isinstance(module, whisper.model.Linear):
+                module.__class__ = torch.nn.Linear
+        model = quantize_int8(model)
+    return WhisperSTT(model)
+
+
+def load_emotion(backend="torch", num_threads=0):
+    """Returns a transformers audio-classification pipeline running on the chosen backend."""
+    if backend not in EMOTION_BACKENDS:
+        raise ValueError(f"Unknown emotion backend: {backend} (expected one of {EMOTION_BACKENDS})")
+    if backend == "onnx":
+        if ORTModelForAudioClassification is None:
+            raise RuntimeError("Emotion backend 'onnx' needs: pip install optimum[onnxruntime]")
+        if not (EMOTION_ONNX_DIR / EMOTION_ONNX_FILE).exists():
+            raise RuntimeError(f"Missing {EMOTION_ONNX_DIR} - run: python export_models.py export --emotion")
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        model = ORTModelForAudioClassification.from_pretrained(
+            EMOTION_ONNX_DIR, file_name=EMOTION_ONNX_FILE, session_options=session_options
+        )
+        feature_extractor = AutoFeatureExtractor.from_pretrained(EMOTION_ONNX_DIR)
+        return pipeline("audio-classification", model=model, feature_extractor=feature_extractor)
+
+    classifier = pipeline("audio-classification", model=EMOTION_MODEL)
+    if backend == "torch-int8":
+        classifier.model = quantize_int8(classifier.model)
+    return classifier
@@ -0,0 +1,134 @@
+import numpy as np
+
+from audio_codecs import StreamingDecoder
+from vad import frame_energy_db, speech_frames
+
+LIVE_FORMATS = ("pcm16", "webm", "ogg")
+
+
+class LiveAudio:
+    """Audio frames from a live connection: raw 16-bit mono PCM at sample_rate, or a webm/ogg
+    recording (e.g. MediaRecorder chunks) decoded on the fly by FFmpeg."""
+
+    def __init__(self, input_format="pcm16", sample_rate=16000):
+        if input_format not in LIVE_FORMATS:
+            raise ValueError(f"Unknown input format: {input_format} (expected one of {LIVE_FORMATS})")
+        self.input_format = input_format
+        self.sample_rate = sample_rate
+        self._remainder = b""
+        self._decoder = self._new_decoder()
+
+    def _new_decoder(self):
+        # Strumień na żywo nie ma limitu długości (-t) - długość wypowiedzi pilnuje UtteranceTracker
+        return None if self.input_format == "pcm16" else StreamingDecoder(self.sample_rate, max_seconds=None)
+
+    def feed(self, data):
+        """Takes one frame; returns the float32 samples that became available."""
+        if self._decoder is not None:
+            self._decoder.feed(data)
+            return self._decoder.read()
+        data = self._remainder + data
+        usable = len(data) // 2 * 2
+        self._remainder = data[usable:]
+        return np.frombuffer(data[:usable], dtype="<i2").astype(np.float32) / 32768.0
+
+    def flush(self, timeout=None):
+        """Ends the current recording and returns its remaining samples; the next frames start a new one."""
+        if self._decoder is None:
+            self._remainder = b""
+            return np.zeros(0, dtype=np.float32)
+        decoder, self._decoder = self._decoder, self._new_decoder()
+        return decoder.finish(timeout)
+
+    def close(self):
+        if self._decoder is not None:
+            self._decoder.abort()
+
+
+class UtteranceTracker:
+    """Collects live audio into utterances and tells when a partial transcript is due
+    and when the speaker has finished (trailing silence after speech, or the length limit).
+
+    Frame energies are computed once, as samples arrive; each update() only re-runs the
+    speech decision over them instead of the VAD over the whole utterance.
+    """
+
+    def __init__(self, sample_rate=16000, partial_interval_ms=1000, end_silence_ms=700, max_seconds=60,
+                 preroll_ms=500, frame_ms=30, **vad_kwargs):
+        self.sample_rate = sample_rate
+        self.partial_interval = int(sample_rate * partial_interval_ms / 1000)
+        self.end_silence_ms = end_silence_ms
+        self.max_samples = int(sample_rate * max_seconds)
+        self.frame_ms = frame_ms
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.preroll_frames = int(preroll_ms / frame_ms)
+        self.vad_kwargs = vad_kwargs
+        self.utterance = 0
+        self._reset()
+
+    def _reset(self):
+        self._chunks = []
+        self._length = 0
+        self._partial_at = 0
+        self._energy = np.zeros(0, dtype=np.float32)
+        # Próbki za ostatnią pełną ramką - wejdą do następnej
+        self._tail = np.zeros(0, dtype=np.float32)
+
+    @property
+    def audio(self):
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        return self._chunks[0] if self._chunks else np.zeros(0, dtype=np.float32)
+
+    def append(self, samples):
+        if not len(samples):
+            return
+        self._chunks.append(samples)
+        self._length += len(samples)
+        pending = np.concatenate((self._tail, samples))
+        usable = len(pending) // self.frame_size * self.frame_size
+        if usable:
+            self._energy = np.concatenate((self._energy, frame_energy_db(pending[:usable], self.frame_size)))
+        self._tail = pending[usable:]
+
+    def _trailing_silence_ms(self):
+        """Milliseconds of silence after the last speech frame, or None if there is no speech yet."""
+        speech = np.flatnonzero(speech_frames(self._energy, self.frame_ms, **self.vad_kwargs))
+        if not len(speech):
+            return None
+        return (self._length - (speech[-1] + 1) * self.frame_size) * 1000 / self.sample_rate
+
+    def update(self):
+        """Returns "end" when the utterance is complete, "partial" when a partial transcript is due, else None."""
+        if not self._length:
+            return None
+        silence = self._trailing_silence_ms()
+        if silence is None:
+            # Przed pierwszym słowem trzymamy tylko krótki pre-roll (pełne ramki + ogon), a nie całą ciszę
+            frames = min(self.preroll_frames, len(self._energy))
+            keep = frames * self.frame_size + len(self._tail)
+            if self._length > keep:
+                audio = self.audio
+                self._chunks, self._length = [audio[len(audio) - keep:]], keep
+                self._energy = self._energy[len(self._energy) - frames:]
+            self._partial_at = self._length
+            return None
+        if silence >= self.end_silence_ms or self._length >= self.max_samples:
+            return "end"
+        if self._length - self._partial_at >= self.partial_interval:
+            self._partial_at = self._length
+            return "partial"
+        return None
+
+    def has_speech(self):
+        return self._trailing_silence_ms() is not None
+
+    def window(self, seconds):
+        return self.audio[-int(self.sample_rate * seconds):]
+
+    def take(self):
+        """Returns the utterance audio and starts a new utterance."""
+        audio = self.audio
+        self.utterance += 1
+        self._reset()
+        return audio
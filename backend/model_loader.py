@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ModelNotReadyError(Exception):
+    """Raised when a model is still loading (or failed to load) and the caller cannot wait longer."""
+
+    def __init__(self, name, state):
+        super().__init__(f"Model '{name}' is not ready ({state})")
+        self.name = name
+        self.state = state
+
+
+class LazyModel:
+    """A model loaded once - eagerly, in a background thread or on first use - with readiness info.
+
+    States: pending -> loading -> ready | error. A failed load is retried on the next get().
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._model = None
+        self.state = "pending"
+        self.error = None
+        self.load_ms = None
+
+    def start(self):
+        """Starts loading in a background thread (no-op if already loading or loaded)."""
+        if self._begin():
+            threading.Thread(target=self._load, daemon=True, name=f"load-{self.name}").start()
+
+    def load(self):
+        """Loads in the calling thread, or waits for a load already in progress."""
+        if self._begin():
+            self._load()
+        else:
+            self._done.wait()
+        return self._result()
+
+    def get(self, timeout=None):
+        """Returns the model, starting the load if needed and waiting up to timeout seconds."""
+        if self.state == "ready":
+            return self._model
+        self.start()
+        self._done.wait(timeout)
+        return self._result()
+
+    def status(self):
+        return {"state": self.state, "load_ms": self.load_ms, "error": self.error}
+
+    def _begin(self):
+        with self._lock:
+            if self.state in ("loading", "ready"):
+                return False
+            self.state = "loading"
+            self.error = None
+            self._done.clear()
+            return True
+
+    def _load(self):
+        logger.info(f"⏳ Ładowanie modelu '{self.name}'...")
+        start = time.perf_counter()
+        try:
+            model = self._loader()
+        except Exception as e:
+            logger.error(f"❌ Nie udało się załadować modelu '{self.name}': {e}")
+            with self._lock:
+                self.state, self.error = "error", str(e)
+        else:
+            with self._lock:
+                self._model = model
+                self.load_ms = round((time.perf_counter() - start) * 1000, 1)
+                self.state = "ready"
+            logger.info(f"✅ Model '{self.name}' gotowy ({self.load_ms} ms)")
+        finally:
+            self._done.set()
+
+    def _result(self):
+        if self.state != "ready":
+            raise ModelNotReadyError(self.name, self.state)
+        return self._model
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import queue
+import selectors
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Piper loguje tę linię na stderr dopiero PO zapisaniu i flushu całego audio danej linii
+# (wątek wyjścia raw jest joinowany wcześniej), więc to pewny znacznik końca wypowiedzi.
+END_OF_UTTERANCE = b"Real-time factor"
+
+# Selektory na potokach działają tylko na systemach POSIX - na Windowsie zostaje tryb jednorazowy
+POOL_SUPPORTED = os.name != "nt"
+
+
+class PiperError(Exception):
+    """Raised when a Piper process fails, crashes or times out."""
+
+
+def piper_command(exe, model_path, config_path, length_scale=1.0, json_input=False):
+    cmd = [
+        str(exe),
+        "-m", str(model_path),
+        "-c", str(config_path),
+        "--output_raw",
+        "--sentence_silence", "0.2",
+        "--length_scale", str(length_scale),
+    ]
+    if json_input:
+        cmd.append("--json-input")
+    return cmd
+
+
+def synthesize_once(exe, model_path, config_path, text, env=None, length_scale=1.0, on_chunk=None):
+    """Fallback without a pool: one Piper process per request, PCM streamed straight from stdout."""
+    proc = subprocess.Popen(
+        piper_command(exe, model_path, config_path, length_scale),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    pcm = bytearray()
+    deliver = on_chunk or pcm.extend
+    stderr_output = []
+
+    def feed():
+        try:
+            proc.stdin.write(text.encode("utf-8"))
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    threading.Thread(target=feed, daemon=True).start()
+    stderr_reader = threading.Thread(target=lambda: stderr_output.append(proc.stderr.read()), daemon=True)
+    stderr_reader.start()
+    try:
+        for chunk in iter(lambda: proc.stdout.read1(32768), b""):
+            deliver(chunk)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        returncode = proc.wait()
+        stderr_reader.join()
+    if returncode != 0:
+        details = b"".join(stderr_output).decode("utf-8", errors="ignore")
+        raise PiperError(details or f"exit code {returncode}")
+    return bytes(pcm)
+
+
+class PiperWorker:
+    """A long-lived Piper process fed with JSON lines on stdin, returning raw PCM on stdout."""
+
+    def __init__(self, exe, model_path, config_path, env=None, length_scale=1.0, timeout=60.0):
+        self.cmd = piper_command(exe, model_path, config_path, length_scale, json_input=True)
+        self.env = env
+        self.timeout = timeout
+        self.proc = None
+        self.utterances = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env,
+        )
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        os.set_blocking(self.proc.stderr.fileno(), False)
+        self.utterances = 0
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def synthesize(self, text, on_chunk=None):
+        """Synthesizes one utterance; PCM chunks go to on_chunk, or are returned joined if it is None."""
+        if not self.alive():
+            raise PiperError("Piper process is not running")
+
+        pcm = bytearray()
+        deliver = on_chunk or pcm.extend
+        payload = json.dumps({"text": text}, ensure_ascii=False) + "\n"
+        try:
+            self.proc.stdin.write(payload.encode("utf-8"))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise PiperError(f"Piper stdin closed: {e}") from e
+
+        stdout_fd = self.proc.stdout.fileno()
+        stderr_fd = self.proc.stderr.fileno()
+        stderr_tail = b""
+        deadline = time.monotonic() + self.timeout
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(stdout_fd, selectors.EVENT_READ)
+            selector.register(stderr_fd, selectors.EVENT_READ)
+            finished = False
+            while not finished:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PiperError("Piper timed out")
+                for key, _ in selector.select(remaining):
+                    data = self._read(key.fd)
+                    if data is None:
+                        continue
+                    if not data:
+                        raise PiperError("Piper process exited unexpectedly")
+                    if key.fd == stdout_fd:
+                        deliver(data)
+                    else:
+                        stderr_tail += data
+                        *lines, stderr_tail = stderr_tail.split(b"\n")
+                        finished = finished or any(END_OF_UTTERANCE in line for line in lines)
+
+        # Całe audio tej linii jest już w potoku - dobieramy resztę bez blokowania
+        while True:
+            data = self._read(stdout_fd)
+            if not data:
+                break
+            deliver(data)
+
+        self.utterances += 1
+        return bytes(pcm)
+
+    @staticmethod
+    def _read(fd):
+        try:
+            return os.read(fd, 65536)
+        except BlockingIOError:
+            return None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+
+class PiperPool:
+    """Fixed-size pool of PiperWorkers for one voice, restarting workers that crash or hang."""
+
+    def __init__(self, exe, model_path, config_path, size=1, env=None, length_scale=1.0,
+                 timeout=60.0, acquire_timeout=30.0):
+        self.name = os.path.basename(str(model_path))
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self._factory = lambda: PiperWorker(exe, model_path, config_path, env, length_scale, timeout)
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.restarts = 0
+        for _ in range(size):
+            worker = self._factory()
+            worker.start()
+            self._workers.append(worker)
+            self._idle.put(worker)
+        logger.info(f"🎙️ Pula Piper '{self.name}': uruchomiono {size} proces(y)")
+
+    def acquire(self):
+        try:
+            worker = self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise PiperError(f"No idle Piper worker for '{self.name}'")
+        # Health check przed użyciem - martwy proces od razu podmieniamy
+        if not worker.alive():
+            worker = self._restart(worker, "process not running")
+        return worker
+
+    def release(self, worker, failed=False):
+        if failed:
+            worker = self._restart(worker, "synthesis failed")
+        self._idle.put(worker)
+
+    def synthesize(self, text, on_chunk=None):
+        worker = self.acquire()
+        failed = False
+        try:
+            return worker.synthesize(text, on_chunk)
+        except Exception:
+            # Proces mógł zostać w połowie wypowiedzi - bezpieczniej go podmienić
+            failed = True
+            raise
+        finally:
+            self.release(worker, failed)
+
+    def _restart(self, worker, reason):
+        logger.warning(f"♻️ Restart procesu Piper '{self.name}' ({reason})")
+        worker.close()
+        replacement = self._factory()
+        replacement.start()
+        with self._lock:
+            self._workers = [replacement if w is worker else w for w in self._workers]
+            self.restarts += 1
+        return replacement
+
+    def stats(self):
+        with self._lock:
+            workers = list(self._workers)
+        return {
+            "size": self.size,
+            "alive": sum(w.alive() for w in workers),
+            "idle": self._idle.qsize(),
+            "restarts": self.restarts,
+            "utterances": sum(w.utterances for w in workers),
+        }
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
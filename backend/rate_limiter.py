@@ -0,0 +1,296 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_VOICE = 0
+PRIORITY_TEXT = 1
+
+# Błędy sieci bez odpowiedzi HTTP - przejściowe jak 5xx
+TRANSIENT_ERRORS = (TimeoutError, asyncio.TimeoutError, ConnectionError)
+try:
+    import httpx
+
+    TRANSIENT_ERRORS += (httpx.TimeoutException, httpx.NetworkError)
+except ImportError:
+    pass
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than allowed for an upstream rate limit slot."""
+
+
+def classify_error(e):
+    """Returns "quota" (daily quota gone), "rate" (per-minute limit), "server" (5xx/timeout) or None.
+
+    Only the HTTP status (e.code) and the exception type count - anything else is not retryable.
+    """
+    if isinstance(e, QueueTimeout):
+        return "rate"
+    code = getattr(e, "code", None)
+    if not isinstance(code, int):
+        return "server" if isinstance(e, TRANSIENT_ERRORS) else None
+    if code == 429:
+        # Limit dzienny nie minie po kilku sekundach - nie ma sensu ponawiać na tym samym modelu;
+        # rodzaj limitu (quotaId) jest tylko w treści odpowiedzi 429
+        text = str(e).lower().replace(" ", "")
+        return "quota" if "perday" in text or "daily" in text else "rate"
+    if code >= 500:
+        return "server"
+    return None
+
+
+def retry_hint(e):
+    # Gemini podpowiada czas w treści błędu ("Please retry in 27.5s" / "retryDelay": "27s")
+    match = re.search(r"retry(?:delay)?\W+(?:in\s+)?([\d.]+)\s*s", str(e), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+
+class PriorityTokenBucket:
+    """Token bucket shared by threads and asyncio tasks; waiting callers are served by priority
+    (lower first), then FIFO. Tasks wait on the event loop, without holding a thread.
+
+    The rate adapts to upstream feedback: halved on a 429, raised back by 10% of the limit per success.
+    """
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.max_rate = rate_per_minute / 60
+        self.min_rate = self.max_rate / 8
+        self.rate = self.max_rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._async_waiters = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_TEXT, timeout=None):
+        entry = (priority, next(self._seq))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    acquired, wait = self._poll(entry, deadline, timeout)
+                    if acquired:
+                        return
+                    self._cond.wait(wait)
+            except BaseException:
+                self._leave(entry)
+                raise
+
+    async def acquire_async(self, priority=PRIORITY_TEXT, timeout=None):
+        """acquire() for asyncio: a cancelled task leaves the queue at once and takes no token."""
+        entry = (priority, next(self._seq))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wakeup = asyncio.Event()
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._async_waiters[entry] = (asyncio.get_running_loop(), wakeup)
+        try:
+            while True:
+                # clear() przed sprawdzeniem - powiadomienie, które przyjdzie później, nie przepadnie
+                wakeup.clear()
+                with self._cond:
+                    acquired, wait = self._poll(entry, deadline, timeout)
+                if acquired:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._leave(entry)
+            raise
+        finally:
+            with self._cond:
+                self._async_waiters.pop(entry, None)
+
+    def _poll(self, entry, deadline, timeout):
+        """Takes a token if entry is first in line; else returns (False, seconds to wait or None)."""
+        now = time.monotonic()
+        self._refill(now)
+        first = self._waiters[0] == entry
+        if first and self.tokens >= 1:
+            self.tokens -= 1
+            heapq.heappop(self._waiters)
+            self._notify()
+            return True, None
+        # Tylko pierwszy w kolejce czeka na token; reszta czeka, aż ktoś przed nią odejdzie
+        wait = (1 - self.tokens) / self.rate if first else None
+        if deadline is not None:
+            remaining = deadline - now
+            if remaining <= 0:
+                raise QueueTimeout(f"Rate limit queue timeout after {timeout}s")
+            wait = remaining if wait is None else min(wait, remaining)
+        return False, wait
+
+    def _leave(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        self._notify()
+
+    def _notify(self):
+        # Budzi wątki czekające na warunku oraz zadania asyncio (każde na swojej pętli)
+        self._cond.notify_all()
+        for loop, wakeup in self._async_waiters.values():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def throttle(self):
+        with self._cond:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self):
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "rate_per_minute": round(self.rate * 60, 2),
+                "tokens": round(self.tokens, 2),
+                "waiting": len(self._waiters),
+            }
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RetryScheduler:
+    """Runs upstream calls through per-model rate limiters with jittered exponential backoff.
+
+    call(model) is tried on the primary model first; when its quota is exhausted (or retries run
+    out) the next model in the list is used, and an exhausted model is skipped for a cooldown.
+    """
+
+    def __init__(self, models, rate_per_minute=0, burst=1, max_retries=3, backoff_base=1.0,
+                 backoff_max=20.0, queue_timeout=30.0, exhausted_cooldown=900.0):
+        self.models = [model for model in models if model]
+        self.limiters = {
+            model: PriorityTokenBucket(rate_per_minute, burst) for model in self.models
+        } if rate_per_minute > 0 else {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self.exhausted_cooldown = exhausted_cooldown
+        self._exhausted_until = {}
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "fallbacks": 0}
+
+    def run(self, call, priority=PRIORITY_TEXT):
+        last_error = None
+        for index, model in enumerate(self._candidate_models()):
+            self._count("fallbacks" if index else "calls")
+            for attempt in range(self.max_retries + 1):
+                self._acquire(model, priority)
+                try:
+                    result = call(model)
+                except Exception as e:
+                    delay = self._on_error(model, e, attempt)
+                    if delay is None:
+                        raise
+                    last_error = e
+                    if delay < 0:
+                        break
+                    time.sleep(delay)
+                    continue
+                self._on_success(model)
+                return result
+        raise last_error
+
+    async def run_async(self, call, priority=PRIORITY_TEXT):
+        """run() for a coroutine function; waiting for a token happens on the event loop."""
+        last_error = None
+        for index, model in enumerate(self._candidate_models()):
+            self._count("fallbacks" if index else "calls")
+            for attempt in range(self.max_retries + 1):
+                await self._acquire_async(model, priority)
+                try:
+                    result = await call(model)
+                except Exception as e:
+                    delay = self._on_error(model, e, attempt)
+                    if delay is None:
+                        raise
+                    last_error = e
+                    if delay < 0:
+                        break
+                    await asyncio.sleep(delay)
+                    continue
+                self._on_success(model)
+                return result
+        raise last_error
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            exhausted = {model: round(until - now) for model, until in self._exhausted_until.items() if until > now}
+            counters = dict(self.counters)
+        return {
+            **counters,
+            "exhausted_models": exhausted,
+            "limiters": {model: limiter.stats() for model, limiter in self.limiters.items()},
+        }
+
+    def _candidate_models(self):
+        now = time.monotonic()
+        with self._lock:
+            available = [m for m in self.models if self._exhausted_until.get(m, 0) <= now]
+        # Wszystkie wyczerpane - próbujemy mimo to (limit mógł się już odnowić)
+        return available or self.models
+
+    def _acquire(self, model, priority):
+        limiter = self.limiters.get(model)
+        if limiter is not None:
+            limiter.acquire(priority, self.queue_timeout)
+
+    async def _acquire_async(self, model, priority):
+        limiter = self.limiters.get(model)
+        if limiter is not None:
+            await limiter.acquire_async(priority, self.queue_timeout)
+
+    def _on_success(self, model):
+        limiter = self.limiters.get(model)
+        if limiter is not None:
+            limiter.recover()
+
+    def _on_error(self, model, e, attempt):
+        """Returns the backoff delay before a retry, -1 to move on to the next model, None to give up."""
+        kind = classify_error(e)
+        if kind is None or isinstance(e, QueueTimeout):
+            return None
+        if kind == "quota":
+            logger.warning(f"🚫 Limit dzienny modelu {model} wyczerpany - przerwa {self.exhausted_cooldown:.0f}s")
+            with self._lock:
+                self._exhausted_until[model] = time.monotonic() + self.exhausted_cooldown
+            return -1
+        if kind == "rate":
+            self._count("throttled")
+            limiter = self.limiters.get(model)
+            if limiter is not None:
+                limiter.throttle()
+        if attempt >= self.max_retries:
+            return -1
+        self._count("retries")
+        # Pełny jitter - równoczesne żądania nie ponawiają w tej samej chwili
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        hint = retry_hint(e)
+        if hint is not None:
+            delay = min(self.backoff_max, max(delay, hint))
+        logger.info(f"🔁 Gemini {model}: błąd przejściowy ({kind}), ponowienie {attempt + 1} za {delay:.1f}s")
+        return delay
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from tts_cache import normalize_text
+
+# Wynik dla czekających, gdy liczący został przerwany (np. klient się rozłączył) - liczą od nowa
+_ABANDONED = object()
+
+
+def canonical_prompt(text):
+    # "Cześć!", "cześć" i "  Cześć " to ta sama pierwsza wiadomość
+    return re.sub(r"[\s.!?…]+$", "", normalize_text(text).casefold())
+
+
+def make_key(model, instruction, language, emotion, user_text):
+    """Key of a first-turn reply: model, system instruction, language, emotion and the canonical user text."""
+    raw = "\x00".join([model, hashlib.sha256(instruction.encode("utf-8")).hexdigest(),
+                       language, emotion or "", canonical_prompt(user_text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """TTL + LRU cache of LLM replies with single-flight: concurrent misses for one key share one call."""
+
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._get_locked(key)
+            if value is None:
+                self.counters["misses"] += 1
+            return value
+
+    def put(self, key, value):
+        if not value or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def get_or_compute(self, key, compute):
+        while True:
+            kind, payload = self._claim(key)
+            if kind == "hit":
+                return payload
+            if kind == "wait":
+                value = payload.result()
+                if value is _ABANDONED:
+                    continue
+                return value
+            try:
+                value = compute()
+            except Exception as e:
+                self._settle(key, payload, error=e)
+                raise
+            except BaseException:
+                self._abandon(key, payload)
+                raise
+            self._settle(key, payload, value=value)
+            return value
+
+    async def get_or_compute_async(self, key, compute):
+        """Same as get_or_compute for a coroutine function; waits for sync and async callers alike.
+
+        A cancelled computing task does not pass CancelledError on: its waiters compute the value again.
+        """
+        while True:
+            kind, payload = self._claim(key)
+            if kind == "hit":
+                return payload
+            if kind == "wait":
+                # shield - anulowanie czekającego nie może anulować wspólnej Future
+                value = await asyncio.shield(asyncio.wrap_future(payload))
+                if value is _ABANDONED:
+                    continue
+                return value
+            try:
+                value = await compute()
+            except Exception as e:
+                self._settle(key, payload, error=e)
+                raise
+            except BaseException:
+                self._abandon(key, payload)
+                raise
+            self._settle(key, payload, value=value)
+            return value
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries), "inflight": len(self._inflight)}
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return value
+
+    def _claim(self, key):
+        """Returns ("hit", value), ("wait", future of the running call) or ("compute", future to settle)."""
+        with self._lock:
+            value = self._get_locked(key)
+            if value is not None:
+                return "hit", value
+            future = self._inflight.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return "wait", future
+            self.counters["misses"] += 1
+            future = self._inflight[key] = Future()
+            return "compute", future
+
+    def _settle(self, key, future, value=None, error=None):
+        if error is None:
+            self.put(key, value)
+        with self._lock:
+            self._inflight.pop(key, None)
+        # Błąd (np. limit API) dostają wszyscy czekający, ale nie trafia do cache
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def _abandon(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(_ABANDONED)
@@ -0,0 +1,178 @@
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Session:
+    id: str
+    history: list = field(default_factory=list)
+    summary: str = ""
+    updated_at: float = field(default_factory=time.time)
+
+
+def roll_history(history, summary, max_messages, summary_max_chars, excerpt_chars=200):
+    """Moves the oldest messages above max_messages into a short extractive summary."""
+    if len(history) <= max_messages:
+        return history, summary
+    overflow, history = history[:-max_messages], history[-max_messages:]
+    lines = [summary] if summary else []
+    for msg in overflow:
+        role = "Użytkownik" if msg.get("role") == "user" else "Asystent"
+        text = " ".join(msg.get("text", "").split())
+        if len(text) > excerpt_chars:
+            text = text[:excerpt_chars].rsplit(" ", 1)[0] + "…"
+        lines.append(f"- {role}: {text}")
+    summary = "\n".join(lines)
+    # Streszczenie też ma limit - najstarsze punkty wypadają jako pierwsze
+    while len(summary) > summary_max_chars and "\n" in summary:
+        summary = summary.split("\n", 1)[1]
+    return history, summary[-summary_max_chars:]
+
+
+class InMemorySessionStore:
+    """Sessions kept in process memory, expired after ttl seconds of inactivity."""
+
+    def __init__(self, ttl=6 * 3600, max_messages=20, summary_max_chars=2000):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.summary_max_chars = summary_max_chars
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+
+    def reopen(self):
+        """Called in a forked worker: locks (and connections) must not be shared with the parent."""
+        self._lock = threading.Lock()
+
+    def create(self, session_id=None, history=None):
+        session = Session(id=session_id or secrets.token_urlsafe(16))
+        session.history, session.summary = roll_history(
+            list(history or []), "", self.max_messages, self.summary_max_chars
+        )
+        with self._lock:
+            self._purge_expired()
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._purge_expired()
+            session = self._sessions.get(session_id)
+            if session is None or time.time() - session.updated_at > self.ttl:
+                return None
+            return Session(session.id, list(session.history), session.summary, session.updated_at)
+
+    def append(self, session_id, messages):
+        with self._lock:
+            self._purge_expired()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(id=session_id)
+            session.history, session.summary = roll_history(
+                session.history + list(messages), session.summary, self.max_messages, self.summary_max_chars
+            )
+            session.updated_at = time.time()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        expired = [sid for sid, s in self._sessions.items() if now - s.updated_at > self.ttl]
+        for sid in expired:
+            del self._sessions[sid]
+
+
+class SqliteSessionStore(InMemorySessionStore):
+    """Same interface as InMemorySessionStore, persisted in a SQLite file (survives restarts)."""
+
+    def __init__(self, path, ttl=6 * 3600, max_messages=20, summary_max_chars=2000):
+        super().__init__(ttl, max_messages, summary_max_chars)
+        self.path = path
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, history TEXT NOT NULL, summary TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def reopen(self):
+        # Połączenia SQLite nie wolno używać w dwóch procesach - każdy worker otwiera własne
+        super().reopen()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+
+    def create(self, session_id=None, history=None):
+        session = Session(id=session_id or secrets.token_urlsafe(16))
+        session.history, session.summary = roll_history(
+            list(history or []), "", self.max_messages, self.summary_max_chars
+        )
+        with self._lock, self._conn:
+            self._purge_expired()
+            self._save(session)
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._purge_expired()
+            row = self._conn.execute(
+                "SELECT history, summary, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return Session(session_id, json.loads(row[0]), row[1], row[2])
+
+    def append(self, session_id, messages):
+        with self._lock, self._conn:
+            self._purge_expired()
+            row = self._conn.execute(
+                "SELECT history, summary FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            history, summary = (json.loads(row[0]), row[1]) if row else ([], "")
+            session = Session(session_id)
+            session.history, session.summary = roll_history(
+                history + list(messages), summary, self.max_messages, self.summary_max_chars
+            )
+            self._save(session)
+
+    def delete(self, session_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def _save(self, session):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (id, history, summary, updated_at) VALUES (?, ?, ?, ?)",
+            (session.id, json.dumps(session.history, ensure_ascii=False), session.summary, time.time()),
+        )
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+
+
+def create_session_store(backend="memory", path="sessions.db", **kwargs):
+    if backend == "sqlite":
+        return SqliteSessionStore(path, **kwargs)
+    if backend == "memory":
+        return InMemorySessionStore(**kwargs)
+    raise ValueError(f"Unknown session backend: {backend}")
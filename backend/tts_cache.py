@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    # Różnice w białych znakach nie zmieniają wypowiedzi - nie chcemy przez nie pudłować w cache
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def make_key(engine, voice, length_scale, text):
+    """Content address of a TTS result: sha256 over engine, voice, length_scale and normalized text."""
+    text_hash = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    raw = f"{engine}\x00{voice}\x00{length_scale}\x00{text_hash}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """In-memory LRU of synthesized audio bounded by bytes, with an optional on-disk spill tier."""
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "not_modified": 0, "evictions": 0}
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_size = sum(p.stat().st_size for p in self.disk_dir.glob("*/*.bin"))
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return data
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+        # Trafienie z dysku wraca do RAM (najczęściej odtwarzane frazy zostają w pamięci)
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        if not data:
+            return
+        self._put_memory(key, data)
+        self._write_disk(key, data)
+
+    def contains(self, key):
+        """True if the audio for key is stored (memory or disk); does not count as a hit or miss."""
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self.disk_dir) and self._disk_path(key).exists()
+
+    def record_not_modified(self):
+        with self._lock:
+            self.counters["not_modified"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counters,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self._disk_size if self.disk_dir else None,
+            }
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.counters["evictions"] += 1
+
+    def _disk_path(self, key):
+        return self.disk_dir / key[:2] / f"{key}.bin"
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mtime = ostatnie użycie, wg niego sprzątamy
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Nie udało się odczytać cache TTS z dysku: {e}")
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        if path.exists():
+            return
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Nie udało się zapisać cache TTS na dysk: {e}")
+            return
+        with self._lock:
+            self._disk_size += len(data)
+            over_limit = self._disk_size > self.disk_max_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Jedno sprzątanie naraz - pozostałe wątki nie muszą na nie czekać
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for path in self.disk_dir.glob("*/*.bin"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            for _, size, path in files:
+                with self._lock:
+                    if self._disk_size <= self.disk_max_bytes * 0.9:
+                        break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                with self._lock:
+                    self._disk_size -= size
+                    self.counters["evictions"] += 1
+        finally:
+            self._evict_lock.release()
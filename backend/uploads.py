@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows - tam serwer działa w jednym procesie i wystarcza UploadStore w pamięci
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UploadError(Exception):
+    """Raised for a chunk that cannot be accepted; carries the HTTP status and the current offset."""
+
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class ChunkedUpload:
+    """One resumable upload: chunks go straight into a streaming decoder, so decoding overlaps the upload."""
+
+    def __init__(self, upload_id, decoder, max_bytes):
+        self.id = upload_id
+        self.decoder = decoder
+        self.max_bytes = max_bytes
+        self.offset = 0
+        self.finished = False
+        self.audio = None
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def append(self, offset, chunks):
+        """Writes chunks starting at byte offset; returns the new offset.
+
+        A chunk that repeats bytes already received (a retry after a lost response) is trimmed,
+        a gap (offset past the end) is rejected with 409 so the client can resume from .offset.
+        Chunks for an upload that is already being processed are rejected with 409 as well.
+        """
+        with self.lock:
+            if self.finished:
+                raise UploadError("Upload already finished", 409)
+            if offset is None:
+                offset = self.offset
+            if offset > self.offset:
+                raise UploadError("Upload offset mismatch", 409, self.offset)
+            position = offset
+            for chunk in chunks:
+                skip = min(len(chunk), self.offset - position)
+                position += len(chunk)
+                if skip < len(chunk):
+                    if position > self.max_bytes:
+                        raise UploadError("Upload too large", 413, self.offset)
+                    self.decoder.feed(chunk[skip:])
+                    self.offset = position
+                self.updated_at = time.monotonic()
+            return self.offset
+
+    def finish(self, timeout=None):
+        """Returns the decoded samples; they are kept, so a retried request does not decode again."""
+        with self.lock:
+            # Po finish() dekoder ma zamknięte wejście - dalsze kawałki nie miałyby dokąd trafić
+            self.finished = True
+            if self.audio is None:
+                self.audio = self.decoder.finish(timeout)
+            return self.audio
+
+    def abort(self):
+        self.decoder.abort()
+
+
+class UploadStore:
+    """Chunked uploads in progress, each with its own decoder; idle ones are dropped after ttl seconds."""
+
+    def __init__(self, decoder_factory, ttl=300, max_bytes=25 * 1024 * 1024, max_active=64):
+        self.decoder_factory = decoder_factory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_active = max_active
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def create(self):
+        self._purge_expired()
+        with self._lock:
+            # Każdy upload to żywy proces FFmpeg - limit chroni serwer przed ich nadmiarem
+            if len(self._uploads) >= self.max_active:
+                raise UploadError("Too many uploads in progress", 503)
+            upload = ChunkedUpload(secrets.token_urlsafe(16), self.decoder_factory(), self.max_bytes)
+            self._uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        with self._lock:
+            return self._uploads.get(upload_id)
+
+    def pop(self, upload_id):
+        with self._lock:
+            return self._uploads.pop(upload_id, None)
+
+    def delete(self, upload_id):
+        upload = self.pop(upload_id)
+        if upload is not None:
+            upload.abort()
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._uploads)}
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [upload for upload in self._uploads.values() if now - upload.updated_at > self.ttl]
+            for upload in expired:
+                del self._uploads[upload.id]
+        for upload in expired:
+            logger.info(f"🗑️ Porzucony upload {upload.id} ({upload.offset} B) - zamykam dekoder")
+            upload.abort()
+
+
+class SpooledUpload:
+    """A chunked upload kept as a file in a spool directory shared by worker processes, so any
+    worker can take its chunks and finish it. Decoding starts at finish(); the samples are kept
+    next to the file (a retried request does not decode again)."""
+
+    def __init__(self, upload_id, directory, decode, max_bytes):
+        self.id = upload_id
+        self.path = directory / f"{upload_id}.part"
+        self.pcm_path = directory / f"{upload_id}.pcm"
+        self.decode = decode
+        self.max_bytes = max_bytes
+
+    @property
+    def offset(self):
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @contextmanager
+    def _locked(self):
+        # flock obejmuje wszystkie procesy - kawałki i finish() tego samego uploadu idą po kolei
+        with open(self.path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+
+    def append(self, offset, chunks):
+        """Same contract as ChunkedUpload.append."""
+        with self._locked() as f:
+            if self.pcm_path.exists():
+                raise UploadError("Upload already finished", 409)
+            size = f.seek(0, os.SEEK_END)
+            if offset is None:
+                offset = size
+            if offset > size:
+                raise UploadError("Upload offset mismatch", 409, size)
+            position = offset
+            for chunk in chunks:
+                skip = min(len(chunk), size - position)
+                position += len(chunk)
+                if skip < len(chunk):
+                    if position > self.max_bytes:
+                        raise UploadError("Upload too large", 413, size)
+                    f.write(chunk[skip:])
+                    size = position
+            return size
+
+    def finish(self, timeout=None):
+        with self._locked() as f:
+            if self.pcm_path.exists():
+                return np.fromfile(self.pcm_path, dtype=np.float32)
+            audio = self.decode(f.read(), timeout)
+            temp_path = self.pcm_path.with_suffix(".pcm.tmp")
+            audio.astype(np.float32).tofile(temp_path)
+            os.replace(temp_path, self.pcm_path)
+            return audio
+
+    def abort(self):
+        for path in (self.path, self.pcm_path):
+            path.unlink(missing_ok=True)
+
+
+class SpoolUploadStore:
+    """UploadStore for several worker processes on one node: uploads are files in a shared directory,
+    so the requests of one upload may land on any worker. Idle ones are dropped after ttl seconds."""
+
+    def __init__(self, directory, decode, ttl=300, max_bytes=25 * 1024 * 1024, max_active=64):
+        if fcntl is None:
+            raise RuntimeError("SpoolUploadStore needs fcntl (Linux/macOS)")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.decode = decode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_active = max_active
+
+    def create(self):
+        self._purge_expired()
+        if len(list(self.directory.glob("*.part"))) >= self.max_active:
+            raise UploadError("Too many uploads in progress", 503)
+        upload = self._upload(secrets.token_urlsafe(16))
+        upload.path.touch(exist_ok=False)
+        return upload
+
+    def get(self, upload_id):
+        # upload_id trafia do ścieżki pliku - tylko znaki z token_urlsafe
+        if not UPLOAD_ID_RE.match(upload_id or ""):
+            return None
+        upload = self._upload(upload_id)
+        try:
+            idle = time.time() - upload.path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        return upload if idle <= self.ttl else None
+
+    def delete(self, upload_id):
+        upload = self.get(upload_id)
+        if upload is not None:
+            upload.abort()
+
+    def stats(self):
+        return {"active": len(list(self.directory.glob("*.part"))), "spool_dir": str(self.directory)}
+
+    def _upload(self, upload_id):
+        return SpooledUpload(upload_id, self.directory, self.decode, self.max_bytes)
+
+    def _purge_expired(self):
+        now = time.time()
+        for path in self.directory.glob("*.part"):
+            try:
+                expired = now - path.stat().st_mtime > self.ttl
+            except FileNotFoundError:
+                continue
+            if expired:
+                logger.info(f"🗑️ Porzucony upload {path.stem} - usuwam plik")
+                self._upload(path.stem).abort()
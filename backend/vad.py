@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class NoSpeechError(Exception):
+    """Raised when a recording contains no speech (silence, noise or an accidental tap)."""
+
+
+def frame_energy_db(audio, frame_size):
+    frames = audio[: len(audio) // frame_size * frame_size].reshape(-1, frame_size)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1) + 1e-12)
+    return 20 * np.log10(rms)
+
+
+def speech_frames(energy, frame_ms=30, threshold_db=-50.0, margin_db=12.0, min_speech_ms=250):
+    """Per-frame speech flags for frame energies in dB; all False when there is too little speech.
+
+    The threshold adapts to the recording: background level (10th percentile) plus margin_db,
+    kept below the loudest frame minus margin_db and never under the absolute threshold_db.
+    """
+    if not len(energy):
+        return np.zeros(0, dtype=bool)
+    threshold = max(threshold_db, min(np.percentile(energy, 10) + margin_db, energy.max() - margin_db))
+    speech = energy > threshold
+    # Same krótkie trzaski (kliknięcie, stuknięcie w mikrofon) to jeszcze nie mowa
+    if speech.sum() * frame_ms < min_speech_ms:
+        speech[:] = False
+    return speech
+
+
+def detect_speech(audio, sample_rate=16000, frame_ms=30, threshold_db=-50.0, margin_db=12.0,
+                  min_speech_ms=250, padding_ms=200):
+    """Energy-based VAD; returns a list of (start, end) sample ranges containing speech."""
+    frame_size = int(sample_rate * frame_ms / 1000)
+    if len(audio) < frame_size:
+        return []
+    speech = speech_frames(frame_energy_db(audio, frame_size), frame_ms, threshold_db, margin_db, min_speech_ms)
+    if not speech.any():
+        return []
+
+    # Margines wokół mowy - nie ucinamy cichych początków/końców słów, krótkie pauzy zostają
+    pad = int(np.ceil(padding_ms / frame_ms))
+    if pad:
+        speech = np.convolve(speech, np.ones(2 * pad + 1), mode="same") > 0
+
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+    return [(start * frame_size, min(end * frame_size, len(audio))) for start, end in zip(edges[::2], edges[1::2])]
+
+
+def trim_silence(audio, sample_rate=16000, **kwargs):
+    """Returns only the speech segments of audio, joined; raises NoSpeechError if there are none."""
+    segments = detect_speech(audio, sample_rate, **kwargs)
+    if not segments:
+        raise NoSpeechError("No speech detected")
+    return np.concatenate([audio[start:end] for start, end in segments])